@@ -0,0 +1,223 @@
+"""
+Alignment of the reused passages of positive pairs. Lemma ngrams shared by a source and a text
+are the seeds, seeds on the same diagonal at consecutive positions are extended to maximal runs,
+and runs close to each other in both documents are joined into passages, which tolerates small
+edits. Passages are reported as character spans of both texts, taken from the token offsets of
+the document cache, so matches can be reviewed without searching the whole articles.
+Run as a script to align all positive pairs of an output DB of own_infer.py.
+"""
+
+import sqlite3
+import argparse
+import multiprocessing
+import time
+
+from pathlib import Path
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ngram_similarity import NgramSimilarity, ngram_hashes
+from doc_cache import DocumentCache
+from text_store import TextStore
+from db_writer import BulkWriter
+from own_infer import chunk, bounded_map
+
+# character spans [start, end) in both texts and the number of aligned tokens of the text
+Passage = namedtuple("Passage", ["a_start", "a_end", "b_start", "b_end", "tokens"])
+
+
+def seed_matches(lemmasa, lemmasb, n=5, max_occurrences=16):
+    """returns the token positions (i, j) of all ngrams of length n shared by A and B.
+    Ngrams occurring more than max_occurrences times in A are no useful seeds and skipped"""
+
+    hashesa = ngram_hashes(lemmasa, n)
+    hashesb = ngram_hashes(lemmasb, n)
+
+    if len(hashesa) == 0 or len(hashesb) == 0:
+        return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+
+    order = np.argsort(hashesa, kind="stable")
+    sorteda = hashesa[order]
+
+    lo = np.searchsorted(sorteda, hashesb, side="left")
+    counts = np.searchsorted(sorteda, hashesb, side="right") - lo
+    counts[counts > max_occurrences] = 0
+
+    # every position of B is paired with all positions of its ngram in A
+    j = np.repeat(np.arange(len(hashesb)), counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    i = order[np.repeat(lo, counts) + within]
+
+    return i.astype('int64'), j.astype('int64')
+
+
+def seed_runs(i, j):
+    """joins seeds on the same diagonal at consecutive positions, returns the
+    start positions in A and B and the number of seeds of every run"""
+
+    if len(i) == 0:
+        return i, j, np.zeros(0, dtype='int64')
+
+    diagonals = j - i
+    order = np.lexsort((i, diagonals))
+    i, j, diagonals = i[order], j[order], diagonals[order]
+
+    starts = np.ones(len(i), dtype=bool)
+    starts[1:] = (diagonals[1:] != diagonals[:-1]) | (i[1:] != i[:-1] + 1)
+    starts = np.flatnonzero(starts)
+
+    return i[starts], j[starts], np.diff(np.append(starts, len(i)))
+
+
+def join_runs(ia, jb, lengths, n=5, max_gap=10):
+    """joins runs that follow each other in both documents with gaps of at most max_gap tokens
+    into token spans [(a0, a1, b0, b1, tokens)], spans of B covered by a longer span are dropped"""
+
+    spans = []
+    current = None
+
+    # runs cover their seeds plus the n - 1 tokens of the last ngram
+    runs = sorted(zip(jb.tolist(), ia.tolist(), (lengths + n - 1).tolist()))
+
+    for b0, a0, length in runs:
+        a1, b1 = a0 + length, b0 + length
+
+        # a run continues a span if it follows it in both documents, overlapping by at most one ngram
+        if current is not None and b0 <= current[3] + max_gap and current[1] - n <= a0 <= current[1] + max_gap:
+            if b1 > current[3]:
+                current[4] += b1 - max(b0, current[3])
+                current[1] = max(current[1], a1)
+                current[3] = b1
+            continue
+
+        if current is not None:
+            spans.append(tuple(current))
+        current = [a0, a1, b0, b1, length]
+
+    if current is not None:
+        spans.append(tuple(current))
+
+    # the same part of B can match repeated parts of A, only the longest alignment is kept
+    kept = []
+    for span in sorted(spans, key=lambda s: -s[4]):
+        if all(span[3] <= other[2] or span[2] >= other[3] for other in kept):
+            kept.append(span)
+
+    return sorted(kept, key=itemgetter(2))
+
+
+def align(arraysa, arraysb, n=5, max_gap=10, min_tokens=8):
+    """returns the Passages of B reused from A, both given as TokenArrays"""
+
+    ia, jb, lengths = seed_runs(*seed_matches(arraysa.lemmas, arraysb.lemmas, n))
+
+    passages = []
+    for a0, a1, b0, b1, tokens in join_runs(ia, jb, lengths, n, max_gap):
+        if tokens < min_tokens:
+            continue
+        passages.append(Passage(
+            int(arraysa.offsets[a0, 0]),
+            int(arraysa.offsets[a1 - 1, 1]),
+            int(arraysb.offsets[b0, 0]),
+            int(arraysb.offsets[b1 - 1, 1]),
+            tokens
+        ))
+
+    return passages
+
+
+def init_worker(language, inpath, cachepath, cache_bytes):
+    global store
+    global scorer
+
+    store = TextStore(inpath, memory_bytes=cache_bytes)
+    cache = DocumentCache(cachepath, language, memory_bytes=cache_bytes) if cachepath else None
+    scorer = NgramSimilarity(language, cache=cache)
+
+
+def align_rows(rows, n, max_gap, min_tokens):
+    """aligns (ida, idb) pairs grouped by source, returns the rows of the passages table"""
+
+    results = []
+
+    for ida, group in groupby(rows, key=itemgetter(0)):
+        arraysa = scorer.text_arrays(store.text("sources", ida))
+        idbs = [idb for _, idb in group]
+
+        for idb, textb in zip(idbs, store.texts("texts", idbs)):
+            for passage in align(arraysa, scorer.text_arrays(textb), n, max_gap, min_tokens):
+                results.append((ida, idb, *passage))
+
+    return results
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-o", default=Path("predictions.db"), dest="outdb",
+        help="Path to the output SQLite DB of own_infer.py, the passages are written to its passages table", type=Path)
+    argparser.add_argument("-i", dest="indb", required=True,
+        help="Path to the input SQLite DB with the texts", type=Path)
+    argparser.add_argument("-c", dest="cachedb", type=Path,
+        help="Path to a document cache DB created by preprocess.py")
+    argparser.add_argument("-l", default="de", dest="language",
+        help="Language of the documents")
+    argparser.add_argument("--label", default="1", dest="label",
+        help="Label of the pairs to align")
+    argparser.add_argument("-n", default=5, type=int, dest="seed_length",
+        help="Length of the lemma ngrams used as seeds")
+    argparser.add_argument("--max-gap", default=10, type=int, dest="max_gap",
+        help="Maximum number of unaligned tokens within a passage")
+    argparser.add_argument("--min-tokens", default=8, type=int, dest="min_tokens",
+        help="Minimum number of aligned tokens of a passage")
+    argparser.add_argument("-t", default=multiprocessing.cpu_count(), type=int, dest="njobs",
+        help="Number of parallel processes. Defaults to all available")
+    argparser.add_argument("-b", default=100, type=int, dest="bundlesize",
+        help="Number of pairs per work bundle")
+    argparser.add_argument("--cache-mb", default=256, type=int, dest="cache_mb",
+        help="Memory budget in MB per worker for each in-process document cache")
+
+    args = argparser.parse_args()
+
+    con = sqlite3.connect(args.outdb)
+    con.executescript("""
+    CREATE TABLE IF NOT EXISTS passages (
+        ida INTEGER NOT NULL,
+        idb INTEGER NOT NULL,
+        a_start INTEGER,
+        a_end INTEGER,
+        b_start INTEGER,
+        b_end INTEGER,
+        tokens INTEGER
+    );
+    """)
+    pairs = con.execute("SELECT ida, idb FROM predictions WHERE label=? ORDER BY ida, idb", (args.label,)).fetchall()
+    con.close()
+
+    print(f"Aligning {len(pairs)} pairs")
+    st = time.time()
+
+    initargs = (args.language, str(args.indb), str(args.cachedb) if args.cachedb else None, args.cache_mb * 2**20)
+    npassages = 0
+
+    with BulkWriter(args.outdb) as writer:
+        # the passages of all pairs are computed again
+        writer.execute("DELETE FROM passages")
+        writer.defer("CREATE INDEX IF NOT EXISTS passages_pair ON passages (ida, idb)")
+
+        with ProcessPoolExecutor(max_workers=args.njobs, initializer=init_worker, initargs=initargs) as executor:
+            results = bounded_map(executor, align_rows, chunk(args.bundlesize, pairs), 2 * args.njobs,
+                args.seed_length, args.max_gap, args.min_tokens)
+
+            for rows in results:
+                writer.executemany("INSERT INTO passages VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                writer.commit()
+                npassages += len(rows)
+
+    print(f"Found {npassages} passages in {len(pairs)} pairs in {time.time() - st} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Benchmarks for the text metrics, the classifier and the whole inference pipeline.
+
+The fixture subcommand writes a reproducible input DB with synthetic German-like texts,
+either small or with the number and length of documents of the METER corpus. The run
+subcommand times NgramSimilarity.score_texts, ModifiedNgramSimilarity.score_texts,
+model.predict and own_infer.py for several worker counts and appends the results as JSON
+lines. compare reports throughput regressions between two result files.
+
+Usage:
+    python benchmark.py fixture -o bench.db --preset meter
+    python benchmark.py run -i bench.db -m ../classifier/modell5.pickle -t 1 2 4 -o benchmarks.jsonl
+    python benchmark.py compare baseline.jsonl benchmarks.jsonl
+"""
+
+import sqlite3
+import argparse
+import json
+import pickle
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from datetime import datetime
+
+import numpy as np
+
+from ngram_similarity import NgramSimilarity
+from modified_ngram_similarity import ModifiedNgramSimilarity
+
+# METER: 772 press agency sources and 944 newspaper texts, the lengths are approximate
+PRESETS = {
+    "synthetic": {"sources": 20, "texts": 50, "words": 300},
+    "meter": {"sources": 772, "texts": 944, "words": 400},
+}
+
+FUNCTION_WORDS = [
+    "der", "die", "das", "und", "in", "zu", "den", "nicht", "von", "sie", "ist", "des", "sich",
+    "mit", "dem", "dass", "er", "es", "ein", "auch", "auf", "eine", "als", "nach", "wie", "im",
+    "für", "man", "aber", "aus", "durch", "wenn", "nur", "war", "noch", "werden", "bei", "hat",
+    "wir", "was", "wird", "sein", "einen", "welche", "sind", "oder", "zur", "um", "haben", "einer",
+]
+
+SYLLABLES = ["ar", "be", "ch", "de", "el", "fa", "ge", "hin", "ig", "ka", "lu", "men", "no",
+    "ost", "pre", "re", "sch", "ter", "un", "ver", "wa", "zen"]
+
+RSS_WRAPPER = """
+import resource, subprocess, sys
+subprocess.run(sys.argv[1:], check=True, stdout=subprocess.DEVNULL)
+print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+"""
+
+
+def make_vocabulary(rng, size=5000):
+    words = set()
+    while len(words) < size:
+        word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        words.add(word.capitalize() if rng.random() < 0.4 else word)
+    return sorted(words)
+
+
+def make_text(rng, vocabulary, nwords):
+    words = [rng.choice(FUNCTION_WORDS) if rng.random() < 0.45 else rng.choice(vocabulary) for _ in range(nwords)]
+    sentences = []
+    while words:
+        length = rng.randint(6, 20)
+        sentence, words = words[:length], words[length:]
+        sentences.append(" ".join(sentence).capitalize() + ".")
+    return " ".join(sentences)
+
+
+def reuse_text(rng, vocabulary, source, nwords):
+    """a text that copies some passages of a source, with a few words exchanged"""
+
+    sourcewords = source.split()
+    words = make_text(rng, vocabulary, nwords).split()
+
+    for _ in range(rng.randint(1, 3)):
+        length = min(rng.randint(20, 60), len(sourcewords))
+        start = rng.randint(0, len(sourcewords) - length)
+        passage = [w if rng.random() > 0.1 else rng.choice(vocabulary) for w in sourcewords[start:start+length]]
+        at = rng.randint(0, len(words))
+        words[at:at] = passage
+
+    return " ".join(words)
+
+
+def write_fixture(path, sources, texts, words, seed=1337, reuse=0.3):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+
+    con = sqlite3.connect(path)
+    con.executescript("""
+    DROP TABLE IF EXISTS sources;
+    DROP TABLE IF EXISTS texts;
+
+    CREATE TABLE sources (
+        id INTEGER PRIMARY KEY,
+        language TEXT,
+        text TEXT
+    );
+
+    CREATE TABLE texts (
+        id INTEGER PRIMARY KEY,
+        language TEXT,
+        text TEXT
+    );
+    """)
+
+    def length():
+        return max(20, int(rng.gauss(words, words / 3)))
+
+    sourcetexts = [make_text(rng, vocabulary, length()) for _ in range(sources)]
+    con.executemany("INSERT INTO sources VALUES (?, 'de', ?)", enumerate(sourcetexts))
+
+    rows = []
+    for id in range(texts):
+        if rng.random() < reuse:
+            rows.append((id, reuse_text(rng, vocabulary, rng.choice(sourcetexts), length())))
+        else:
+            rows.append((id, make_text(rng, vocabulary, length())))
+    con.executemany("INSERT INTO texts VALUES (?, 'de', ?)", rows)
+
+    con.commit()
+    con.close()
+
+
+def sample_pairs(con, npairs, seed=1337):
+    """a reproducible random sample of (source text, text) pairs"""
+
+    rng = random.Random(seed)
+    sources = con.execute("SELECT text FROM sources ORDER BY id").fetchall()
+    texts = con.execute("SELECT text FROM texts ORDER BY id").fetchall()
+    return [(rng.choice(sources)[0], rng.choice(texts)[0]) for _ in range(npairs)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def record(benchmark, params, n, times, **extra):
+    best = min(times)
+    return {
+        "benchmark": benchmark,
+        "params": params,
+        "n": n,
+        "seconds": best,
+        "median_seconds": statistics.median(times),
+        "per_second": n / best if best else None,
+        **extra,
+        "commit": git_commit(),
+        "time": datetime.now().isoformat(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+    }
+
+
+def bench_metric(scorer, pairs, repeat, reset=None):
+    times = []
+    for _ in range(repeat):
+        if reset:
+            reset()
+        st = time.perf_counter()
+        for texta, textb in pairs:
+            scorer.score_texts(texta, textb)
+        times.append(time.perf_counter() - st)
+    return times
+
+
+def bench_predict(model, nrows, repeat, seed=1337):
+    nfeatures = getattr(model, "n_features_in_", 6)
+    features = np.random.default_rng(seed).random((nrows, nfeatures), dtype='float32')
+
+    times = []
+    for _ in range(repeat):
+        st = time.perf_counter()
+        model.predict(features)
+        times.append(time.perf_counter() - st)
+    return times
+
+
+def bench_infer(indb, modelpath, npairs, njobs, extra):
+    """runs own_infer.py on the first npairs pairs, returns the wall time and peak RSS in MB of the largest process"""
+
+    infer = Path(__file__).with_name("own_infer.py")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cmd = [
+            sys.executable, str(infer),
+            "-i", str(indb),
+            "-m", str(modelpath),
+            "-o", str(Path(tmp) / "predictions.db"),
+            "-t", str(njobs),
+            "-e", str(npairs + 1),
+            *extra
+        ]
+
+        st = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", RSS_WRAPPER, *cmd], check=True, capture_output=True, text=True)
+        elapsed = time.perf_counter() - st
+
+    return elapsed, int(out.stdout.strip().splitlines()[-1]) / 1024
+
+
+def run(args):
+    con = sqlite3.connect(args.indb)
+    pairs = sample_pairs(con, args.pairs)
+    con.close()
+
+    fixture = {"indb": Path(args.indb).name, "pairs": args.pairs}
+    results = []
+
+    scorer = NgramSimilarity(args.language)
+    times = bench_metric(scorer, pairs, args.repeat)
+    results.append(record("ngs.score_texts", fixture, len(pairs), times))
+
+    if not args.skip_mngs:
+        scorer = ModifiedNgramSimilarity(args.language, synonyms=args.synonyms)
+        times = bench_metric(scorer, pairs, args.repeat, reset=scorer.memory.clear)
+        results.append(record("mngs.score_texts", {**fixture, "synonyms": bool(args.synonyms)}, len(pairs), times))
+
+    with args.modelpath.open(mode="rb") as f:
+        model = pickle.load(f)
+    times = bench_predict(model, args.predict_rows, args.repeat)
+    results.append(record("model.predict", {"model": args.modelpath.name}, args.predict_rows, times))
+
+    extra = ["--mngs"] if not args.skip_mngs else []
+    if args.synonyms:
+        extra += ["--synonyms", str(args.synonyms)]
+
+    for njobs in args.njobs:
+        elapsed, rss = bench_infer(args.indb, args.modelpath, args.infer_pairs, njobs, extra)
+        params = {"indb": Path(args.indb).name, "pairs": args.infer_pairs, "njobs": njobs, "mngs": not args.skip_mngs}
+        results.append(record("own_infer", params, args.infer_pairs, [elapsed], peak_rss_mb=rss))
+
+    with args.outpath.open(mode="a", encoding="utf-8") as f:
+        for r in results:
+            f.write(json.dumps(r) + "\n")
+            print(f"{r['benchmark']} {json.dumps(r['params'])}: {r['per_second']:.1f}/s")
+
+
+def load_results(path):
+    """latest result per benchmark and parameters of a results file"""
+
+    results = dict()
+    with Path(path).open(encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                results[(r["benchmark"], json.dumps(r["params"], sort_keys=True))] = r
+    return results
+
+
+def compare(args):
+    baseline = load_results(args.baseline)
+    current = load_results(args.current)
+
+    regressions = 0
+    for key in sorted(baseline.keys() & current.keys()):
+        ratio = current[key]["per_second"] / baseline[key]["per_second"]
+        flag = "REGRESSION" if ratio < 1 - args.threshold else ""
+        regressions += bool(flag)
+        print(f"{key[0]} {key[1]}: {baseline[key]['per_second']:.1f}/s -> {current[key]['per_second']:.1f}/s ({ratio:.2f}x) {flag}")
+
+    return regressions
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    subparsers = argparser.add_subparsers(dest="command", required=True)
+
+    fixtureparser = subparsers.add_parser("fixture", help="Write a synthetic input DB")
+    fixtureparser.add_argument("-o", dest="outdb", required=True, type=Path,
+        help="Path to the fixture SQLite DB to write")
+    fixtureparser.add_argument("--preset", default="synthetic", choices=PRESETS.keys(),
+        help="Number and length of the documents")
+    fixtureparser.add_argument("--seed", default=1337, type=int,
+        help="Seed of the text generator")
+
+    runparser = subparsers.add_parser("run", help="Run all benchmarks on an input DB and append the results")
+    runparser.add_argument("-i", dest="indb", required=True, type=Path,
+        help="Path to the input SQLite DB, e.g. a fixture")
+    runparser.add_argument("-m", dest="modelpath", required=True, type=Path,
+        help="Path to the pickled ScikitLearn model to use")
+    runparser.add_argument("-o", default=Path("benchmarks.jsonl"), dest="outpath", type=Path,
+        help="JSON lines file to append the results to")
+    runparser.add_argument("-l", default="de", dest="language",
+        help="Language of the documents")
+    runparser.add_argument("-t", default=[1, 2, 4], nargs="+", type=int, dest="njobs",
+        help="Worker counts to run own_infer.py with")
+    runparser.add_argument("-n", default=200, type=int, dest="pairs",
+        help="Number of sampled pairs for the metric benchmarks")
+    runparser.add_argument("-r", default=3, type=int, dest="repeat",
+        help="Repetitions of the metric and predict benchmarks, the fastest one is reported")
+    runparser.add_argument("--infer-pairs", default=2000, type=int, dest="infer_pairs",
+        help="Number of pairs own_infer.py scores per worker count")
+    runparser.add_argument("--predict-rows", default=100_000, type=int, dest="predict_rows",
+        help="Number of feature rows for the predict benchmark")
+    runparser.add_argument("--synonyms", type=Path, dest="synonyms",
+        help="Synonym table for the modified ngram similarity")
+    runparser.add_argument("--skip-mngs", default=False, action="store_true", dest="skip_mngs",
+        help="Do not benchmark the modified ngram similarity")
+
+    compareparser = subparsers.add_parser("compare", help="Compare the throughput of two result files")
+    compareparser.add_argument("baseline", type=Path)
+    compareparser.add_argument("current", type=Path)
+    compareparser.add_argument("--threshold", default=0.1, type=float,
+        help="Relative throughput loss reported as regression")
+
+    args = argparser.parse_args()
+
+    if args.command == "fixture":
+        write_fixture(args.outdb, seed=args.seed, **PRESETS[args.preset])
+    elif args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        sys.exit(1 if compare(args) else 0)
+
+if __name__ == "__main__":
+    main()
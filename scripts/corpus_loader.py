@@ -0,0 +1,238 @@
+"""
+Shared ingestion of the corpora into SQLite. The files of a corpus are parsed in a process pool,
+XML incrementally with lxml's iterparse so only one story or text is held as a tree at a time,
+and the rows are bulk inserted in large transactions through a BulkWriter, in the order of the files.
+"""
+
+import io
+import json
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from html.entities import name2codepoint
+from itertools import islice
+
+from lxml import etree
+
+# entities used by the METER corpus, which comes without its DTD
+METER_ENTITIES = b"""
+<!ENTITY half	"&#x00BD;"> <!-- VULGAR FRACTION ONE HALF -->
+<!ENTITY frac12	"&#x00BD;"> <!-- VULGAR FRACTION ONE HALF -->
+<!ENTITY frac14	"&#x00BC;"> <!-- VULGAR FRACTION ONE QUARTER -->
+<!ENTITY frac34	"&#x00BE;"> <!-- VULGAR FRACTION THREE QUARTERS -->
+<!ENTITY frac18	"&#x215B;"> <!--  -->
+<!ENTITY frac38	"&#x215C;"> <!--  -->
+<!ENTITY frac58	"&#x215D;"> <!--  -->
+<!ENTITY frac78	"&#x215E;"> <!--  -->
+<!ENTITY sup1	"&#x00B9;"> <!-- SUPERSCRIPT ONE -->
+<!ENTITY sup2	"&#x00B2;"> <!-- SUPERSCRIPT TWO -->
+<!ENTITY sup3	"&#x00B3;"> <!-- SUPERSCRIPT THREE -->
+<!ENTITY plus	"&#x002B;"> <!-- PLUS SIGN -->
+<!ENTITY plusmn	"&#x00B1;"> <!-- PLUS-MINUS SIGN -->
+<!ENTITY lt	"&#38;#60;"> <!-- LESS-THAN SIGN -->
+<!ENTITY equals	"&#x003D;"> <!-- EQUALS SIGN -->
+<!ENTITY gt	"&#x003E;"> <!-- GREATER-THAN SIGN -->
+<!ENTITY divide	"&#x00F7;"> <!-- DIVISION SIGN -->
+<!ENTITY times	"&#x00D7;"> <!-- MULTIPLICATION SIGN -->
+<!ENTITY curren	"&#x00A4;"> <!-- CURRENCY SIGN -->
+<!ENTITY pound	"&#x00A3;"> <!-- POUND SIGN -->
+<!ENTITY dollar	"&#x0024;"> <!-- DOLLAR SIGN -->
+<!ENTITY cent	"&#x00A2;"> <!-- CENT SIGN -->
+<!ENTITY yen	"&#x00A5;"> <!-- YEN SIGN -->
+<!ENTITY num	"&#x0023;"> <!-- NUMBER SIGN -->
+<!ENTITY percnt	"&#x0025;"> <!-- PERCENT SIGN -->
+<!ENTITY amp	"&#38;#38;"> <!-- AMPERSAND -->
+<!ENTITY ast	"&#x002A;"> <!-- ASTERISK OPERATOR -->
+<!ENTITY commat	"&#x0040;"> <!-- COMMERCIAL AT -->
+<!ENTITY lsqb	"&#x005B;"> <!-- LEFT SQUARE BRACKET -->
+<!ENTITY bsol	"&#x005C;"> <!-- REVERSE SOLIDUS -->
+<!ENTITY rsqb	"&#x005D;"> <!-- RIGHT SQUARE BRACKET -->
+<!ENTITY lcub	"&#x007B;"> <!-- LEFT CURLY BRACKET -->
+<!ENTITY horbar	"&#x2015;"> <!-- HORIZONTAL BAR -->
+<!ENTITY verbar	"&#x007C;"> <!-- VERTICAL LINE -->
+<!ENTITY rcub	"&#x007D;"> <!-- RIGHT CURLY BRACKET -->
+<!ENTITY micro	"&#x00B5;"> <!-- MICRO SIGN -->
+<!ENTITY ohm	"&#x2126;"> <!-- OHM SIGN -->
+<!ENTITY deg	"&#x00B0;"> <!-- DEGREE SIGN -->
+<!ENTITY ordm	"&#x00BA;"> <!-- MASCULINE ORDINAL INDICATOR -->
+<!ENTITY ordf	"&#x00AA;"> <!-- FEMININE ORDINAL INDICATOR -->
+<!ENTITY sect	"&#x00A7;"> <!-- SECTION SIGN -->
+<!ENTITY para	"&#x00B6;"> <!-- PILCROW SIGN -->
+<!ENTITY middot	"&#x00B7;"> <!-- MIDDLE DOT -->
+<!ENTITY larr	"&#x2190;"> <!-- LEFTWARDS DOUBLE ARROW -->
+<!ENTITY rarr	"&#x2192;"> <!-- RIGHTWARDS DOUBLE ARROW -->
+<!ENTITY uarr	"&#x2191;"> <!-- UPWARDS ARROW -->
+<!ENTITY darr	"&#x2193;"> <!-- DOWNWARDS ARROW -->
+<!ENTITY copy	"&#x00A9;"> <!-- COPYRIGHT SIGN -->
+<!ENTITY reg	"&#x00AE;"> <!-- REG TRADE MARK SIGN -->
+<!ENTITY trade	"&#x2122;"> <!-- TRADE MARK SIGN -->
+<!ENTITY brvbar	"&#x00A6;"> <!-- BROKEN BAR -->
+<!ENTITY not	"&#x00AC;"> <!-- NOT SIGN -->
+<!ENTITY sung	"&#x2669;"> <!--  -->
+<!ENTITY excl	"&#x0021;"> <!-- EXCLAMATION MARK -->
+<!ENTITY iexcl	"&#x00A1;"> <!-- INVERTED EXCLAMATION MARK -->
+<!ENTITY quot	"&#x0022;"> <!-- QUOTATION MARK -->
+<!ENTITY apos	"&#x0027;"> <!-- APOSTROPHE -->
+<!ENTITY lpar	"&#x0028;"> <!-- LEFT PARENTHESIS -->
+<!ENTITY rpar	"&#x0029;"> <!-- RIGHT PARENTHESIS -->
+<!ENTITY comma	"&#x002C;"> <!-- COMMA -->
+<!ENTITY lowbar	"&#x005F;"> <!-- LOW LINE -->
+<!ENTITY hyphen	"&#x002D;"> <!-- HYPHEN-MINUS -->
+<!ENTITY period	"&#x002E;"> <!-- FULL STOP -->
+<!ENTITY sol	"&#x002F;"> <!-- SOLIDUS -->
+<!ENTITY colon	"&#x003A;"> <!-- COLON -->
+<!ENTITY semi	"&#x003B;"> <!-- SEMICOLON -->
+<!ENTITY quest	"&#x003F;"> <!-- QUESTION MARK -->
+<!ENTITY iquest	"&#x00BF;"> <!-- INVERTED QUESTION MARK -->
+<!ENTITY laquo	"&#x00AB;"> <!-- LEFT-POINTING DOUBLE ANGLE QUOTATION MARK -->
+<!ENTITY raquo	"&#x00BB;"> <!-- RIGHT-POINTING DOUBLE ANGLE QUOTATION MARK -->
+<!ENTITY lsquo	"&#x2018;"> <!--  -->
+<!ENTITY rsquo	"&#x2019;"> <!-- RIGHT SINGLE QUOTATION MARK -->
+<!ENTITY ldquo	"&#x201C;"> <!--  -->
+<!ENTITY rdquo	"&#x201D;"> <!-- RIGHT DOUBLE QUOTATION MARK -->
+<!ENTITY nbsp	"&#x00A0;"> <!-- NO-BREAK SPACE -->
+<!ENTITY shy	"&#x00AD;"> <!-- SOFT HYPHEN -->
+"""
+
+# the HTML parser used before resolved all named HTML entities, the METER declarations take precedence
+HTML_ENTITIES = b"".join(
+    f'<!ENTITY {name}\t"&#x{codepoint:04X};">\n'.encode("ascii")
+    for name, codepoint in sorted(name2codepoint.items())
+    if name not in ["lt", "amp", "gt", "quot", "apos"]
+)
+
+XML_DECLARATION = re.compile(rb"\s*<\?xml[^>]*\?>")
+DOCTYPE = re.compile(rb"<!DOCTYPE[^>\[]*")
+
+
+def declare_entities(buf, entities):
+    """adds entity declarations to the internal DTD subset of an XML document"""
+
+    doctype = DOCTYPE.search(buf)
+
+    if doctype is None:
+        declaration = XML_DECLARATION.match(buf)
+        end = declaration.end() if declaration else 0
+        return buf[:end] + b"<!DOCTYPE TEI.2 [" + entities + b"]>" + buf[end:]
+
+    end = doctype.end()
+    if buf[end:end+1] == b"[":
+        return buf[:end+1] + entities + buf[end+1:]
+    return buf[:end] + b"[" + entities + b"]" + buf[end:]
+
+
+def local_name(el):
+    return etree.QName(el).localname.lower()
+
+
+def attribute(el, name):
+    """attribute lookup ignoring the case of the name, like the HTML parser used before"""
+
+    for key, value in el.attrib.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def iter_elements(source, tag, **kwargs):
+    """yields the elements with a tag name once they are completely parsed
+    and frees them and everything before them afterwards"""
+
+    for _, el in etree.iterparse(source, events=("end",), recover=True, **kwargs):
+        if local_name(el) != tag:
+            continue
+
+        yield el
+
+        el.clear(keep_tail=True)
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+
+
+def descendants(el, tag):
+    return [d for d in el.iter(etree.Element) if d is not el and local_name(d) == tag]
+
+
+def element_text(el):
+    return "".join(el.itertext())
+
+
+def parse_meter(path):
+    """parses a METER TEI file into stories of (catchline, source, texts). The source is
+    (publication, date, type, text), the texts are (publication, date, type, text, label)"""
+
+    with open(path, mode="rb") as f:
+        buf = declare_entities(f.read(), METER_ENTITIES + HTML_ENTITIES)
+
+    stories = []
+
+    for text in iter_elements(io.BytesIO(buf), "text"):
+        # catchline for grouping similar stories
+        catchline = attribute(text, "n")
+        if catchline is None:
+            continue
+
+        divs = descendants(text, "div")
+
+        # first, gather all source texts into one
+        sources = [div for div in divs if attribute(div, "ana") == "src"]
+
+        stype = attribute(sources[0], "type")
+        spub, sdate, _ = attribute(sources[0], "n").split('-')
+        stext = "\n".join(element_text(s) for s in sources).strip()
+        source = (spub, datetime.strptime(sdate, "%d%m%Y").isoformat(), stype, stext)
+
+        # then all the press texts
+        texts = []
+        for div in divs:
+            tlabel = attribute(div, "ana")
+            if tlabel not in ["wd", "pd", "nd"]:
+                continue
+
+            tpub, tdate, _ = attribute(div, "n").split('-')
+            texts.append((tpub, datetime.strptime(tdate, "%d%m%Y").isoformat(), attribute(div, "type"), element_text(div).strip(), tlabel))
+
+        stories.append((catchline, source, texts))
+
+    return stories
+
+
+def parse_bnc(path):
+    """returns the written text of a BNC XML file, None if it has none"""
+
+    for wtext in iter_elements(str(path), "wtext"):
+        return element_text(wtext).strip()
+    return None
+
+
+def parse_json(path):
+    """loads a scraped article, each file holds a single JSON object"""
+
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def parse_files(parse, paths, njobs=None, chunksize=16):
+    """yields (path, parse(path)) for all paths in their order, parsing njobs files at once in separate processes"""
+
+    paths = list(paths)
+    with ProcessPoolExecutor(max_workers=njobs) as executor:
+        yield from zip(paths, executor.map(parse, paths, chunksize=chunksize))
+
+
+def insert_rows(writer, sql, rows, size=10000):
+    """bulk inserts rows through a BulkWriter in batches of size rows, returns their number"""
+
+    rows = iter(rows)
+    n = 0
+
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            break
+        writer.executemany(sql, batch)
+        writer.commit()
+        n += len(batch)
+
+    return n
@@ -0,0 +1,144 @@
+"""
+Output writer shared by the scoring scripts. All writes to an output DB go through a queue to
+a dedicated thread, which owns the SQLite connection, batches them into large transactions and
+creates deferred indexes once at the end, so DB I/O does not block the scoring pipeline.
+"""
+
+import sqlite3
+import threading
+import queue
+import time
+
+
+def tune_connection(con):
+    """pragmas for bulk writing: WAL journaling lets readers continue while the writer works,
+    synchronous=NORMAL only syncs at checkpoints, which is safe in WAL mode"""
+
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-131072")
+    return con
+
+
+class BulkWriter():
+    """Writes to a SQLite DB on a dedicated thread.
+
+    Statements are executed in the order they are queued. commit marks a point at which a
+    transaction may end, it is only committed once at least commit_rows rows or commit_seconds
+    have passed since the last commit. So statements queued between two commit calls (e.g.
+    results and the progress they belong to) always become visible together, but transactions
+    stay large. Errors of the writer thread are raised by the next call on the writer."""
+
+    def __init__(self, path, commit_rows=100_000, commit_seconds=30, queue_size=64):
+        self.path = path
+        self.commit_rows = commit_rows
+        self.commit_seconds = commit_seconds
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.deferred = []
+        self.error = None
+        self.closed = False
+
+        # seconds the writer thread spent executing statements
+        self.busy = 0.0
+
+        self.thread = threading.Thread(target=self.run, name="BulkWriter", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def run(self):
+        con = tune_connection(sqlite3.connect(self.path))
+        pending = 0
+        committed = time.time()
+
+        while True:
+            kind, sql, params = self.queue.get()
+            st = time.perf_counter()
+
+            try:
+                if self.error is not None:
+                    # after an error everything is only drained, so producers never block
+                    pass
+                elif kind == "execute":
+                    con.execute(sql, params)
+                    pending += 1
+                elif kind == "executemany":
+                    con.executemany(sql, params)
+                    pending += len(params)
+                elif kind == "executescript":
+                    con.executescript(sql)
+                elif kind == "commit" and pending < self.commit_rows and time.time() - committed < self.commit_seconds:
+                    pass
+                elif kind in ["commit", "flush", "close"]:
+                    con.commit()
+                    pending = 0
+                    committed = time.time()
+
+                if kind == "close" and self.error is None:
+                    for sql in self.deferred:
+                        con.execute(sql)
+                    con.commit()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.busy += time.perf_counter() - st
+                self.queue.task_done()
+
+            if kind == "close":
+                con.close()
+                return
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError(f"Writing to {self.path} failed") from self.error
+        if self.closed:
+            raise RuntimeError(f"Writer for {self.path} is closed")
+
+    def put(self, kind, sql=None, params=()):
+        self.check()
+        self.queue.put((kind, sql, params))
+
+    def execute(self, sql, params=()):
+        self.put("execute", sql, params)
+
+    def executemany(self, sql, rows):
+        self.put("executemany", sql, list(rows))
+
+    def executescript(self, sql):
+        self.put("executescript", sql)
+
+    def commit(self):
+        """marks the end of a group of statements that may be committed, without waiting for it"""
+
+        self.put("commit")
+
+    def defer(self, sql):
+        """queues a statement, e.g. CREATE INDEX, to run once after all writes when the writer is closed"""
+
+        self.check()
+        self.deferred.append(sql)
+
+    def flush(self):
+        """waits until everything queued so far is written and committed"""
+
+        self.put("flush")
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.closed:
+            return
+
+        # queued directly, the thread has to stop even after an error
+        self.queue.put(("close", None, ()))
+        self.closed = True
+        self.thread.join()
+
+        if self.error is not None:
+            raise RuntimeError(f"Writing to {self.path} failed") from self.error
@@ -0,0 +1,189 @@
+"""
+Collapsing of exact and near-exact duplicate documents, e.g. agency copy syndicated by many
+newspapers. Every document gets a hash of its normalised text and a MinHash signature of its
+word shingles. A document whose hash is already known, or whose signature is similar enough
+to that of a canonical document found via LSH, is recorded in the aliases table with its
+canonical document. own_infer.py --dedup then only scores the canonical documents and copies
+their predictions to all aliases.
+Run as a script to deduplicate the documents already stored in a DB.
+"""
+
+import sqlite3
+import argparse
+import hashlib
+import multiprocessing
+import re
+import time
+import unicodedata
+import zlib
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+from minhash import MinHash, LSHIndex
+
+TOKEN = re.compile(r"\w+")
+SHINGLE_LENGTH = 5
+SHINGLE_PRIME = np.uint64(1099511628211)
+
+MINHASH = MinHash(bands=20, rows=5)
+
+
+def normalize(text):
+    """lowercased word tokens of a text, so copies only differing in case, punctuation or whitespace are equal"""
+
+    return " ".join(TOKEN.findall(unicodedata.normalize("NFKC", text).lower()))
+
+
+def shingle_hashes(normalized, k=SHINGLE_LENGTH):
+    """unique hashes of the word k-shingles of a normalised text"""
+
+    tokens = normalized.split()
+    if not tokens:
+        return np.zeros(0, dtype='uint64')
+
+    k = min(k, len(tokens))
+    hashes = np.array([zlib.crc32(token.encode("utf-8")) for token in tokens], dtype='uint64')
+
+    # polynomial hash of every window, uint64 arithmetic wraps around
+    powers = SHINGLE_PRIME ** np.arange(k, dtype='uint64')
+    return np.unique((sliding_window_view(hashes, k) * powers).sum(axis=1, dtype='uint64'))
+
+
+def document_key(text, minhash=MINHASH):
+    """returns the hash of the normalised text and the MinHash signature of its shingles"""
+
+    normalized = normalize(text)
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest(), minhash.signature(shingle_hashes(normalized))
+
+
+class DuplicateIndex():
+    """Canonical documents by normalised text hash and by LSH over their signatures."""
+
+    def __init__(self, minhash=MINHASH, threshold=0.9):
+        self.minhash = minhash
+        self.threshold = threshold
+
+        self.hashes = dict()
+        self.signatures = dict()
+        self.lsh = LSHIndex(minhash)
+
+    def add_canonical(self, id, texthash, signature):
+        self.hashes.setdefault(texthash, id)
+        self.signatures[id] = signature
+        self.lsh.add(id, signature)
+
+    def add(self, id, texthash, signature):
+        """adds a document, returns (canonical id, estimated Jaccard similarity)
+        if it duplicates a canonical document and None if it becomes canonical itself"""
+
+        canonical = self.hashes.get(texthash)
+        if canonical is not None:
+            return canonical, 1.0
+
+        best = None
+        for candidate in self.lsh.candidates(signature):
+            similarity = float(np.mean(self.signatures[candidate] == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (candidate, similarity)
+
+        if best is None:
+            self.add_canonical(id, texthash, signature)
+        return best
+
+
+def setup(con):
+    con.executescript("""
+    CREATE TABLE IF NOT EXISTS document_keys (
+        tbl TEXT NOT NULL,
+        id NOT NULL,
+        texthash TEXT,
+        params TEXT,
+        signature BLOB,
+        PRIMARY KEY (tbl, id)
+    );
+
+    CREATE TABLE IF NOT EXISTS aliases (
+        tbl TEXT NOT NULL,
+        id NOT NULL,
+        canonical NOT NULL,
+        similarity REAL,
+        PRIMARY KEY (tbl, id)
+    );
+
+    CREATE INDEX IF NOT EXISTS aliases_canonical ON aliases (tbl, canonical);
+    """)
+
+
+def load_index(con, tbl, threshold=0.9, minhash=MINHASH):
+    """builds the DuplicateIndex of the canonical documents of a table stored so far"""
+
+    index = DuplicateIndex(minhash, threshold)
+
+    sql = """
+    SELECT id, texthash, signature FROM document_keys
+    WHERE tbl=? AND params=? AND id NOT IN (SELECT id FROM aliases WHERE tbl=?)
+    ORDER BY rowid
+    """
+    for id, texthash, signature in con.execute(sql, (tbl, minhash.params, tbl)):
+        index.add_canonical(id, texthash, np.frombuffer(signature, dtype='uint64'))
+
+    return index
+
+
+def key_rows(tbl, id, texthash, signature, duplicate, minhash=MINHASH):
+    """rows of the document_keys and aliases tables for a document added to a DuplicateIndex"""
+
+    keyrow = (tbl, id, texthash, minhash.params, np.asarray(signature, dtype='uint64').tobytes())
+    aliasrow = (tbl, id, *duplicate) if duplicate is not None else None
+    return keyrow, aliasrow
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", dest="indb", required=True,
+        help="Path to the input SQLite DB", type=Path)
+    argparser.add_argument("--tables", default=["sources", "texts"], nargs="+", choices=["sources", "texts"], dest="tables",
+        help="Document tables to deduplicate")
+    argparser.add_argument("--threshold", default=0.9, type=float, dest="threshold",
+        help="Minimum estimated Jaccard similarity of the word shingles for near duplicates")
+    argparser.add_argument("-t", default=multiprocessing.cpu_count(), type=int, dest="njobs",
+        help="Number of processes computing the signatures. Defaults to all available cores")
+
+    args = argparser.parse_args()
+
+    con = sqlite3.connect(args.indb)
+    setup(con)
+
+    for tbl in args.tables:
+        st = time.time()
+        index = load_index(con, tbl, args.threshold)
+
+        # documents with a key are already deduplicated
+        rows = con.execute(f"""
+        SELECT id, text FROM {tbl}
+        WHERE id NOT IN (SELECT id FROM document_keys WHERE tbl=? AND params=?)
+        ORDER BY rowid""", (tbl, MINHASH.params)).fetchall()
+
+        naliases = 0
+        with ProcessPoolExecutor(max_workers=args.njobs) as executor:
+            keys = executor.map(document_key, (text for _, text in rows), chunksize=64)
+
+            for (id, _), (texthash, signature) in zip(rows, keys):
+                keyrow, aliasrow = key_rows(tbl, id, texthash, signature, index.add(id, texthash, signature))
+                con.execute("INSERT OR REPLACE INTO document_keys VALUES (?, ?, ?, ?, ?)", keyrow)
+                if aliasrow is not None:
+                    con.execute("INSERT OR REPLACE INTO aliases VALUES (?, ?, ?, ?)", aliasrow)
+                    naliases += 1
+
+        con.commit()
+        print(f"{tbl}: {naliases} of {len(rows)} new documents are duplicates ({time.time() - st} s)")
+
+    con.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import sqlite3
+import hashlib
+import io
+import os
+
+from collections import namedtuple
+
+import numpy as np
+
+from lru_cache import LRUCache
+
+# version of the stored document format, bump whenever the layout of the stored documents changes
+FORMAT = "4"
+
+CachedDocument = namedtuple("CachedDocument", ["lemmas", "pos", "offsets", "sets", "ngram_length"])
+
+
+def pack_arrays(arrays):
+    buf = io.BytesIO()
+    np.savez(buf, **{str(key): value for key, value in arrays.items()})
+    return buf.getvalue()
+
+
+def unpack_sets(blob, ngram_length):
+    with np.load(io.BytesIO(blob)) as f:
+        sets = {n: f[str(n)] for n in range(1, ngram_length+1)}
+        sets['hapax'] = f['hapax']
+    return sets
+
+
+class DocumentCache():
+    """Persistent cache of preprocessed documents.
+
+    Token arrays and ngram sets are stored per document in a SQLite side table,
+    keyed by the SHA1 hash of the document text. An in-process LRU with a memory
+    budget avoids repeated decoding of documents that are used in many pairs."""
+
+    def __init__(self, path, language, memory_bytes=256 * 2**20):
+        self.path = path
+        self.language = language
+        self.memory_bytes = memory_bytes
+        self.memory = LRUCache(memory_bytes)
+
+        self._con = None
+        self._pid = None
+
+        self.setup()
+
+    @property
+    def con(self):
+        # SQLite connections must not be shared with forked worker processes
+        if self._pid != os.getpid():
+            self._con = sqlite3.connect(self.path)
+            self._pid = os.getpid()
+        return self._con
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_con"] = None
+        state["_pid"] = None
+        state["memory"] = LRUCache(self.memory_bytes)
+        return state
+
+    def setup(self):
+        setupsql = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS documents (
+            texthash TEXT PRIMARY KEY,
+            ngram_length INTEGER,
+            lemmas BLOB,
+            pos BLOB,
+            offsets BLOB,
+            sets BLOB
+        );
+
+        CREATE TABLE IF NOT EXISTS lemma_strings (
+            hash INTEGER PRIMARY KEY,
+            string TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS signatures (
+            texthash TEXT NOT NULL,
+            params TEXT NOT NULL,
+            ngram_length INTEGER NOT NULL,
+            signature BLOB,
+            PRIMARY KEY (texthash, params, ngram_length)
+        );
+
+        CREATE TABLE IF NOT EXISTS set_sizes (
+            texthash TEXT NOT NULL,
+            ngram_length INTEGER NOT NULL,
+            sizes BLOB,
+            PRIMARY KEY (texthash, ngram_length)
+        );
+
+        CREATE TABLE IF NOT EXISTS document_ids (
+            tbl TEXT NOT NULL,
+            id TEXT NOT NULL,
+            texthash TEXT NOT NULL,
+            PRIMARY KEY (tbl, id)
+        );
+        """
+        self.con.executescript(setupsql)
+
+        # caches written before the format was versioned stored pickled sets
+        if self.con.execute("SELECT 1 FROM documents LIMIT 1").fetchone() is not None:
+            self.con.execute("INSERT OR IGNORE INTO meta VALUES ('format', '1')")
+
+        self.con.execute("INSERT OR IGNORE INTO meta VALUES ('language', ?)", (self.language,))
+        self.con.execute("INSERT OR IGNORE INTO meta VALUES ('format', ?)", (FORMAT,))
+        self.con.commit()
+
+        meta = dict(self.con.execute("SELECT key, value FROM meta"))
+        if meta["language"] != self.language:
+            raise ValueError(f"Cache {self.path} was built for language {meta['language']}, not {self.language}")
+        if meta["format"] != FORMAT:
+            raise ValueError(f"Cache {self.path} has format {meta['format']}, expected {FORMAT}. Rebuild it with preprocess.py")
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def __contains__(self, text):
+        texthash = self.key(text)
+        if texthash in self.memory:
+            return True
+        return self.con.execute("SELECT 1 FROM documents WHERE texthash=?", (texthash,)).fetchone() is not None
+
+    def get(self, text):
+        """returns the CachedDocument for a text or None if it was never cached"""
+
+        texthash = self.key(text)
+
+        entry = self.memory.get(texthash)
+        if entry is not None:
+            return entry
+
+        row = self.con.execute("SELECT lemmas, pos, offsets, sets, ngram_length FROM documents WHERE texthash=?", (texthash,)).fetchone()
+        if row is None:
+            return None
+
+        lemmas, pos, offsets, sets, ngram_length = row
+        entry = CachedDocument(
+            np.frombuffer(lemmas, dtype='uint64'),
+            np.frombuffer(pos, dtype='uint8'),
+            np.frombuffer(offsets, dtype='uint32').reshape(-1, 2),
+            unpack_sets(sets, ngram_length),
+            ngram_length
+        )
+        self.memory.put(texthash, entry)
+
+        return entry
+
+    def put(self, text, arrays, sets, ngram_length, commit=True):
+        """stores the TokenArrays and sets of a text"""
+
+        texthash = self.key(text)
+        self.con.execute(
+            "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                texthash,
+                ngram_length,
+                np.asarray(arrays.lemmas, dtype='uint64').tobytes(),
+                np.asarray(arrays.pos, dtype='uint8').tobytes(),
+                np.asarray(arrays.offsets, dtype='uint32').tobytes(),
+                pack_arrays(sets)
+            )
+        )
+        if commit:
+            self.con.commit()
+        return texthash
+
+    def put_strings(self, strings, commit=True):
+        """stores lemma strings by their hash, so synonyms can be looked up for cached documents"""
+
+        self.con.executemany(
+            "INSERT OR IGNORE INTO lemma_strings VALUES (?, ?)",
+            ((int(np.uint64(h).astype('int64')), string) for h, string in strings.items())
+        )
+        if commit:
+            self.con.commit()
+
+    def get_string(self, h):
+        row = self.con.execute("SELECT string FROM lemma_strings WHERE hash=?", (int(np.uint64(h).astype('int64')),)).fetchone()
+        return row[0] if row else None
+
+    def get_signature(self, text, params, ngram_length):
+        row = self.con.execute(
+            "SELECT signature FROM signatures WHERE texthash=? AND params=? AND ngram_length=?",
+            (self.key(text), params, ngram_length)
+        ).fetchone()
+        return np.frombuffer(row[0], dtype='uint64') if row else None
+
+    def put_signature(self, text, params, ngram_length, signature, commit=True):
+        self.con.execute(
+            "INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?)",
+            (self.key(text), params, ngram_length, np.asarray(signature, dtype='uint64').tobytes())
+        )
+        if commit:
+            self.con.commit()
+
+    def get_sizes(self, text, ngram_length):
+        row = self.con.execute(
+            "SELECT sizes FROM set_sizes WHERE texthash=? AND ngram_length=?",
+            (self.key(text), ngram_length)
+        ).fetchone()
+        return np.frombuffer(row[0], dtype='int64') if row else None
+
+    def put_sizes(self, text, ngram_length, sizes, commit=True):
+        self.con.execute(
+            "INSERT OR REPLACE INTO set_sizes VALUES (?, ?, ?)",
+            (self.key(text), ngram_length, np.asarray(sizes, dtype='int64').tobytes())
+        )
+        if commit:
+            self.con.commit()
+
+    def put_id(self, tbl, id, text, commit=True):
+        self.con.execute("INSERT OR REPLACE INTO document_ids VALUES (?, ?, ?)", (tbl, str(id), self.key(text)))
+        if commit:
+            self.con.commit()
+
+    def commit(self):
+        self.con.commit()
+
+    def close(self):
+        if self._con is not None and self._pid == os.getpid():
+            self._con.close()
+        self._con = None
+        self._pid = None
@@ -0,0 +1,171 @@
+"""
+Optional per-stage instrumentation of the scoring pipeline. The hot paths wrap their stages in
+stage(name), which costs nothing while the process-wide metrics are disabled. Worker processes
+hand their collected timings back with every result and the main process aggregates them
+with a MetricsReporter, which periodically emits progress records as JSON lines and/or
+into a metrics table of the output DB.
+"""
+
+import cProfile
+import json
+import os
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from multiprocessing.util import Finalize
+from pathlib import Path
+
+DISABLED = nullcontext()
+
+
+class Metrics():
+    """Wall time and number of calls per stage plus free counters of one process.
+    Stages may be nested, the time of a stage includes the time of the stages inside it."""
+
+    def __init__(self):
+        self.enabled = False
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def stage(self, name):
+        if not self.enabled:
+            return DISABLED
+        return self.timed(name)
+
+    @contextmanager
+    def timed(self, name):
+        st = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - st
+            self.counts[name] += 1
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] += n
+
+    def add(self, snapshot):
+        for name, seconds in snapshot["seconds"].items():
+            self.seconds[name] += seconds
+        for name, count in snapshot["counts"].items():
+            self.counts[name] += count
+
+    def collect(self):
+        """returns and resets everything gathered since the last call"""
+
+        snapshot = {"seconds": dict(self.seconds), "counts": dict(self.counts)}
+        self.seconds.clear()
+        self.counts.clear()
+        return snapshot
+
+
+# process-wide metrics used by the stage and count shortcuts
+metrics = Metrics()
+
+
+def stage(name):
+    return metrics.stage(name)
+
+
+def count(name, n=1):
+    metrics.count(name, n)
+
+
+def enable_profile(directory, name):
+    """profiles the rest of this process and writes the stats to directory/name-pid.prof at exit"""
+
+    profile = cProfile.Profile()
+    path = Path(directory) / f"{name}-{os.getpid()}.prof"
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    def dump():
+        profile.disable()
+        profile.dump_stats(path)
+
+    # runs at the exit of pool worker processes as well, where atexit handlers do not
+    Finalize(profile, dump, exitpriority=10)
+    profile.enable()
+    return profile
+
+
+class MetricsReporter():
+    """Aggregates the metrics of all processes of a run and emits progress records."""
+
+    def __init__(self, total, njobs, interval=30, path=None, writer=None, run_id=None):
+        self.total = total
+        self.njobs = njobs
+        self.interval = interval
+        self.path = path
+        self.writer = writer
+        self.run_id = run_id
+
+        self.metrics = Metrics()
+        self.caches = dict()
+
+        self.started = time.time()
+        self.emitted = self.started
+
+        if self.writer is not None:
+            self.writer.execute("""
+            CREATE TABLE IF NOT EXISTS metrics (
+                run_id INTEGER,
+                time TEXT,
+                data TEXT
+            )""")
+
+    def update(self, snapshot, caches=None, pid=None):
+        """adds the snapshot of a process, caches are its cumulative cache stats"""
+
+        if snapshot:
+            self.metrics.add(snapshot)
+        if caches:
+            self.caches[pid] = caches
+
+    def record(self, done):
+        elapsed = time.time() - self.started
+        rate = done / elapsed if elapsed else 0
+
+        caches = defaultdict(lambda: {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0})
+        for workercaches in self.caches.values():
+            for name, stats in workercaches.items():
+                for key in caches[name]:
+                    caches[name][key] += stats.get(key, 0)
+        for stats in caches.values():
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0
+
+        busy = self.metrics.seconds.get("worker.bundle", 0)
+
+        return {
+            "time": datetime.now().isoformat(),
+            "run_id": self.run_id,
+            "elapsed": elapsed,
+            "pairs_done": done,
+            "pairs_total": self.total,
+            "pairs_per_s": rate,
+            "eta_s": (self.total - done) / rate if rate else None,
+            "worker_utilization": busy / (elapsed * self.njobs) if elapsed else 0,
+            "writer_busy_s": self.writer.busy if self.writer is not None else None,
+            "stages": {name: {"seconds": self.metrics.seconds[name], "calls": self.metrics.counts.get(name, 0)} for name in sorted(self.metrics.seconds)},
+            "counters": {name: n for name, n in sorted(self.metrics.counts.items()) if name not in self.metrics.seconds},
+            "caches": dict(caches),
+        }
+
+    def due(self):
+        return time.time() - self.emitted >= self.interval
+
+    def emit(self, done):
+        record = self.record(done)
+        self.emitted = time.time()
+
+        if self.path is not None:
+            with Path(self.path).open(mode="a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+        if self.writer is not None:
+            self.writer.execute("INSERT INTO metrics VALUES (?, ?, ?)", (self.run_id, record["time"], json.dumps(record)))
+
+        return record
@@ -4,13 +4,17 @@ The resulting database consists of two tables for sources (INSM publications) an
 """
 
 import sqlite3
-import json
+import argparse
+import multiprocessing
+import time
 
 from pathlib import Path
 from datetime import datetime
+from collections import defaultdict
 
-con = sqlite3.connect("own3.db")
-cur = con.cursor()
+from corpus_loader import parse_json, parse_files
+from dedup import setup as setup_dedup, load_index, key_rows, document_key
+from db_writer import BulkWriter
 
 sql_create = """
 CREATE TABLE IF NOT EXISTS sources (
@@ -36,7 +40,7 @@ CREATE TABLE IF NOT EXISTS texts (
 CREATE TABLE IF NOT EXISTS predictions (
     ida INTEGER NOT NULL,
     idb INTEGER NOT NULL,
-    scores TEXT,
+    scores BLOB,
     label TEXT,
     FOREIGN KEY(ida) REFERENCES sources(id)
     FOREIGN KEY(idb) REFERENCES texts(id)
@@ -44,14 +48,12 @@ CREATE TABLE IF NOT EXISTS predictions (
 );
 """
 
-cur.executescript(sql_create)
 
-scraped_base = Path("../quellen/artikel/extracted/")
+def scraped_row(p):
+    """returns the table, row and dedup key of a scraped article, None if it is filtered out"""
+
+    data = parse_json(p)
 
-for p in scraped_base.rglob("*.json"):
-    with p.open(encoding="utf-8") as f:
-        data = json.load(f)
-    
     finger = data["fingerprint"]
     date = datetime.strptime(data["date"], r"%Y-%m-%d").isoformat() if data["date"] else None
     title = data["title"]
@@ -61,7 +63,7 @@ for p in scraped_base.rglob("*.json"):
     url = data["source"]
 
     if "insm" in publication.lower(): # skip insm material from tweets for now
-        continue
+        return None
 
     if len(text) < 2500 \
         or "sport" in url \
@@ -70,33 +72,22 @@ for p in scraped_base.rglob("*.json"):
         or "lifestyle" in url \
         or "leute" in url \
         or "Jetzt weiterlesen. Mit dem passenden SPIEGEL-Abo." in text:
-        continue
+        return None
 
-    table = "sources "if "insm" in publication.lower() else "texts"
-    sql = "INSERT OR IGNORE INTO {} VALUES (?, ?, ?, ?, ?, ?, ?)".format(table)
+    table = "sources" if "insm" in publication.lower() else "texts"
 
     cat = [t.strip() for t in [title, text] if t]
 
-    cur.execute(sql,
-        (
-            finger,
-            publication,
-            "de",
-            date,
-            author,
-            url,
-            "\n".join(cat).strip()
-        )
-    )
-
-con.commit()
-
-insm_base = Path("../insm_pressemeldungen/")
-
-for p in insm_base.rglob("*.json"):
-    with p.open(encoding="utf-8") as f:
-        data = json.load(f)
-    
+    text = "\n".join(cat).strip()
+
+    return table, (finger, publication, "de", date, author, url, text), document_key(text)
+
+
+def insm_row(p):
+    """returns the table, row and dedup key of an INSM press release, None if it is filtered out"""
+
+    data = parse_json(p)
+
     finger = data["fingerprint"]
     date = datetime.strptime(data["date"], r"%Y-%m-%d").isoformat() if data["date"] else None
     title = data["title"]
@@ -106,23 +97,90 @@ for p in insm_base.rglob("*.json"):
     url = data["source"]
 
     if len(text) < 2500:
-        continue
-
-    sql = "INSERT OR IGNORE INTO sources VALUES (?, ?, ?, ?, ?, ?, ?)"
+        return None
 
     cat = [t.strip() for t in [title, text] if t]
 
-    cur.execute(sql,
-        (
-            finger,
-            publication,
-            "de",
-            date,
-            author,
-            url,
-            "\n".join(cat).strip()
-        )
-    )
-
-con.commit()
-con.close()
+    text = "\n".join(cat).strip()
+
+    return "sources", (finger, publication, "de", date, author, url, text), document_key(text)
+
+
+def write_batches(writer, batches):
+    sql = {
+        "sources": "INSERT OR IGNORE INTO sources VALUES (?, ?, ?, ?, ?, ?, ?)",
+        "texts": "INSERT OR IGNORE INTO texts VALUES (?, ?, ?, ?, ?, ?, ?)",
+        "document_keys": "INSERT OR REPLACE INTO document_keys VALUES (?, ?, ?, ?, ?)",
+        "aliases": "INSERT OR REPLACE INTO aliases VALUES (?, ?, ?, ?)",
+    }
+    for table, rows in batches.items():
+        writer.executemany(sql[table], rows)
+    batches.clear()
+    writer.commit()
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-o", default=Path("own3.db"), dest="outdb",
+        help="Path to the output SQLite DB", type=Path)
+    argparser.add_argument("--scraped", default=Path("../quellen/artikel/extracted/"), dest="scraped",
+        help="Directory of the scraped articles as JSON files", type=Path)
+    argparser.add_argument("--insm", default=Path("../insm_pressemeldungen/"), dest="insm",
+        help="Directory of the INSM press releases as JSON files", type=Path)
+    argparser.add_argument("-t", default=multiprocessing.cpu_count(), type=int, dest="njobs",
+        help="Number of files parsed in parallel. Defaults to all available cores")
+    argparser.add_argument("--dedup-threshold", default=0.9, type=float, dest="dedup_threshold",
+        help="Minimum estimated Jaccard similarity of the word shingles for near duplicates, see dedup.py")
+
+    args = argparser.parse_args()
+
+    con = sqlite3.connect(args.outdb)
+    con.executescript(sql_create)
+    setup_dedup(con)
+
+    # documents already stored win, like with INSERT OR IGNORE
+    ids = {table: {id for id, in con.execute(f"SELECT id FROM {table}")} for table in ["sources", "texts"]}
+    indexes = {table: load_index(con, table, args.dedup_threshold) for table in ["sources", "texts"]}
+    con.close()
+
+    st = time.time()
+
+    with BulkWriter(args.outdb) as writer:
+        for base, parse in [(args.scraped, scraped_row), (args.insm, insm_row)]:
+            batches = defaultdict(list)
+            nfiles = 0
+            nrows = 0
+            naliases = 0
+
+            for _, row in parse_files(parse, base.rglob("*.json"), args.njobs, chunksize=256):
+                nfiles += 1
+                if row is None:
+                    continue
+
+                table, values, (texthash, signature) = row
+                id = values[0]
+                if id in ids[table]:
+                    continue
+                ids[table].add(id)
+
+                # duplicates are stored as well, but only their canonical document is scored
+                keyrow, aliasrow = key_rows(table, id, texthash, signature, indexes[table].add(id, texthash, signature))
+                batches[table].append(values)
+                batches["document_keys"].append(keyrow)
+                if aliasrow is not None:
+                    batches["aliases"].append(aliasrow)
+                    naliases += 1
+                nrows += 1
+
+                if len(batches[table]) >= 10000:
+                    write_batches(writer, batches)
+
+            write_batches(writer, batches)
+            writer.flush()
+
+            print(f"Loaded {nrows} of {nfiles} files from {base}, {naliases} of them duplicates, in {time.time() - st} s")
+
+    print(f"Completed in {time.time() - st} s")
+
+if __name__ == "__main__":
+    main()
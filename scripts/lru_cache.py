@@ -0,0 +1,93 @@
+import sys
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+def sizeof(obj):
+    """approximate memory footprint of cached values in bytes"""
+
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + 112
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(sizeof(e) for e in obj)
+    else:
+        return sys.getsizeof(obj)
+
+
+class LRUCache():
+    """Least recently used cache with a memory budget in bytes and hit/miss counters."""
+
+    def __init__(self, max_bytes=256 * 2**20, sizeof=sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self.data = OrderedDict()
+        self.sizes = dict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+
+        self.misses += 1
+        return default
+
+    def put(self, key, value, size=None):
+        if key in self.data:
+            self.nbytes -= self.sizes.pop(key)
+            del self.data[key]
+
+        size = self.sizeof(value) if size is None else size
+
+        # values larger than the whole budget are not cached at all
+        if size > self.max_bytes:
+            return value
+
+        self.data[key] = value
+        self.sizes[key] = size
+        self.nbytes += size
+
+        while self.nbytes > self.max_bytes:
+            oldkey, _ = self.data.popitem(last=False)
+            self.nbytes -= self.sizes.pop(oldkey)
+            self.evictions += 1
+
+        return value
+
+    def get_or_compute(self, key, fn, *args):
+        value = self.get(key, self)
+        if value is self:
+            value = self.put(key, fn(*args))
+        return value
+
+    def clear(self):
+        self.data.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.data),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
@@ -0,0 +1,96 @@
+"""
+MinHash signatures and LSH banding over lemma ngrams, used as a near-duplicate prefilter
+that surfaces likely reuse pairs in roughly linear time instead of scoring the full cross join.
+"""
+
+from collections import defaultdict
+
+import numpy as np
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+class MinHash():
+
+    def __init__(self, bands=20, rows=5, seed=1337):
+        self.bands = bands
+        self.rows = rows
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=bands * rows, dtype='uint64')
+        self.b = rng.integers(0, MERSENNE_PRIME, size=bands * rows, dtype='uint64')
+
+    @property
+    def params(self):
+        return f"minhash:{self.bands}x{self.rows}:{self.seed}"
+
+    def signature(self, grams):
+        """computes the MinHash signature of an array of ngram hashes as returned by make_sets"""
+
+        values = np.asarray(grams, dtype='uint64') % MERSENNE_PRIME
+
+        if len(values) == 0:
+            return np.full(self.bands * self.rows, np.iinfo('uint64').max, dtype='uint64')
+
+        # uint64 arithmetic wraps around, which is fine for permuting the hashed ngrams
+        permuted = (self.a[:, None] * values[None, :] + self.b[:, None]) % MERSENNE_PRIME
+        return permuted.min(axis=1)
+
+    def band_keys(self, signature):
+        for band in range(self.bands):
+            yield (band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+
+
+class LSHIndex():
+
+    def __init__(self, minhash):
+        self.minhash = minhash
+        self.buckets = defaultdict(list)
+
+    def add(self, id, signature):
+        for key in self.minhash.band_keys(signature):
+            self.buckets[key].append(id)
+
+    def candidates(self, signature):
+        """returns the ids of all indexed documents sharing at least one band with a signature"""
+
+        found = set()
+        for key in self.minhash.band_keys(signature):
+            found.update(self.buckets.get(key, ()))
+        return found
+
+
+def document_signature(minhash, scorer, text, n):
+    """returns the signature of a text, taking it from the scorer's document cache if possible"""
+
+    cache = scorer.cache
+
+    if cache is not None:
+        signature = cache.get_signature(text, minhash.params, n)
+        if signature is not None:
+            return signature
+
+    signature = minhash.signature(scorer.text_sets(text, n)[n])
+
+    if cache is not None:
+        cache.put_signature(text, minhash.params, n, signature, commit=False)
+
+    return signature
+
+
+def lsh_pairs(con, scorer, bands=20, rows=5, n=5):
+    """yields (source id, text id) pairs of a database that share at least one LSH band"""
+
+    minhash = MinHash(bands, rows)
+    index = LSHIndex(minhash)
+
+    for id, text in con.execute("SELECT id, text FROM sources").fetchall():
+        index.add(id, document_signature(minhash, scorer, text, n))
+
+    for idb, text in con.execute("SELECT id, text FROM texts"):
+        for ida in index.candidates(document_signature(minhash, scorer, text, n)):
+            yield (ida, idb)
+
+    if scorer.cache is not None:
+        scorer.cache.commit()
@@ -1,35 +1,97 @@
 import itertools
 
-from collections import Counter
+from collections import Counter, namedtuple
 from collections.abc import Iterable
 
-import spacy
 import numpy as np
 
 from nltk.util import ngrams
 from spacy.strings import hash_string as spacy_hash_string
+from spacy.parts_of_speech import IDS as POS_IDS, NAMES as POS_NAMES
+
+from ngram_similarity import ngram_hashes, extend_hashes, FNV_OFFSET
+from doc_cache import DocumentCache
+from lru_cache import LRUCache
+from synonym_table import SynonymTable, SYNONYM_POS, load_wordnet, lemma_synonyms
+from tokenizer import load_pipeline, doc_arrays, TokenArrays
+from instrumentation import stage, count
+
+# per-document expansion of a text B: lemma hashes and, per token, the lemma options
+# used by modified_ngrams (synonym hashes, or the lemma itself) as a flat array with offsets
+Expansion = namedtuple("Expansion", ["lemmas", "options", "offsets"])
+
+
+def lookup_counts(acount, hashes):
+    """looks up the counts of ngram hashes in a (sorted unique hashes, counts) pair"""
+
+    unique, counts = acount
+
+    if len(unique) == 0:
+        return np.zeros(len(hashes), dtype='int64')
+
+    pos = np.minimum(np.searchsorted(unique, hashes), len(unique) - 1)
+    return np.where(unique[pos] == hashes, counts[pos], 0)
+
+
+def expanded_counts(expansion, acounts, ngram_length):
+    """For every ngram of B (by start position and length n) sums up the counts in A of all
+    variants in the product of its lemma options, i.e. exp_count without the plain lemma ngram.
+
+    The product is expanded one position at a time for all ngrams at once. Partial ngrams that
+    do not occur in A can not be the prefix of a longer ngram of A and are dropped, so the
+    product explosion of modified_ngrams never materialises."""
+
+    lemmas, options, offsets = expansion
+    ntokens = len(lemmas)
+    lengths = np.diff(offsets)
+
+    result = dict()
+
+    origin = np.arange(ntokens)
+    hashes = np.full(ntokens, FNV_OFFSET, dtype='uint64')
+
+    for n in range(1, ngram_length+1):
+        tok = origin + n - 1
+        valid = tok < ntokens
+        origin, hashes, tok = origin[valid], hashes[valid], tok[valid]
+
+        reps = lengths[tok]
+        origin = np.repeat(origin, reps)
+        hashes = np.repeat(hashes, reps)
+        within = np.arange(reps.sum()) - np.repeat(np.cumsum(reps) - reps, reps)
+        hashes = extend_hashes(hashes, options[np.repeat(offsets[tok], reps) + within])
+
+        counts = lookup_counts(acounts[n], hashes)
+        result[n] = np.bincount(origin, weights=counts, minlength=max(ntokens - n + 1, 0))
+
+        found = counts > 0
+        origin, hashes = origin[found], hashes[found]
+
+    return result
 
 class ModifiedNgramSimilarity():
 
-    def __init__(self, language):
+    def __init__(self, language, cache=None, synonyms=None, cache_bytes=256 * 2**20):
         self.language = language
+        self.cache = cache
 
-        if language == "en":
-            from nltk.corpus import wordnet as wn
-            self.wn = wn
-            self.nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
-        elif language == "de":
-            from germanetpy import germanet
-            self.wn = germanet.Germanet("../ressourcen/GermaNet/GN_V140/GN_V140_XML/")
-            self.nlp = spacy.load("de_core_news_sm", disable=["parser", "ner"])
-        else:
-            raise ValueError(f"Unsupported language {language}")
+        self.nlp = load_pipeline(language)
 
-        self.nlp.max_length = 2_000_000
+        # with a precompiled synonym table the wordnet itself is never loaded
+        if synonyms is not None:
+            self.synonyms = synonyms if isinstance(synonyms, SynonymTable) else SynonymTable(synonyms)
+            if self.synonyms.language != language:
+                raise ValueError(f"Synonym table {self.synonyms.path} is for language {self.synonyms.language}")
+            self.wn = None
+        else:
+            self.synonyms = None
+            self.wn = load_wordnet(language)
 
-        self.counter_cache = dict()
         self.synset_cache = dict()
 
+        # per-document counters, expansions and ngram counts, keyed by document content
+        self.memory = LRUCache(cache_bytes)
+
 
     def flatten_multilemma_ngrams(self, ngrams):
         """Takes ngrams that may contain a list of token options in every place
@@ -50,48 +112,45 @@ class ModifiedNgramSimilarity():
             
 
     def get_lemma_synset(self, token):
-        if self.language == "en":
-            posmap = {
-                "NOUN": "n",
-                "VERB": "v",
-                "ADJ": "a",
-                "ADV": "r",
-            }
-
-            wnpos = posmap[token.pos_]
-            ss = self.wn.synsets(token.lemma_, wnpos)
-            if len(ss) == 1:
-                lemmaset = {l.name() for l in ss[0].lemmas() if not "_" in l.name() and l.name() != token.lemma_}
-            else:
-                lemmaset = {s.lemmas()[0].name() for s in ss if not "_" in s.lemmas()[0].name() and s.lemmas()[0].name() != token.lemma_}
+        return lemma_synonyms(self.wn, self.language, token.lemma_, token.pos_)
 
-            return list(lemmaset)[:10]
-        elif self.language == "de":
-            posmap = {
-                "NOUN": "nomen",
-                "VERB": "verben",
-                "ADJ": "adj",
-                "ADV": None,
-            }
 
-            wnpos = posmap[token.pos_]
+    def synonym_hashes(self, token):
+        """returns the hashed synonyms of a token or None if it has none"""
 
-            if not wnpos:
-                return [token.lemma_]
-            else:
-                ss = self.wn.get_synsets_by_orthform(token.lemma_)
-                
-                if len(ss) == 1 and ss[0].word_category.name == wnpos:
-                    output = {lu.orthform for lu in ss[0].lexunits if lu.orthform != token.lemma_}
-                else:
-                    output = set()
-                    for s in ss:
-                        if s.word_category.name == wnpos:
-                            for lu in s.lexunits:
-                                if lu.orthform != token.lemma_:
-                                    output.add(lu.orthform)
+        return self.lemma_synonym_hashes(token.lemma, token.pos_, token.lemma_)
+
+
+    def lemma_synonym_hashes(self, lemma, pos_, lemma_=None):
+        """returns the hashed synonyms of a lemma hash with a POS tag or None if it has none"""
+
+        if pos_ not in SYNONYM_POS:
+            return None
+
+        if self.synonyms is not None:
+            return self.synonyms.lookup(lemma, POS_IDS[pos_])
+
+        if lemma_ is None:
+            lemma_ = self.lemma_string(lemma)
 
-                return list(output)[:10]
+        if not (lemma_, pos_) in self.synset_cache:
+            self.synset_cache[(lemma_, pos_)] = lemma_synonyms(self.wn, self.language, lemma_, pos_)
+        ss = self.synset_cache[(lemma_, pos_)]
+        if ss:
+            return [spacy_hash_string(l) for l in ss]
+        return None
+
+
+    def lemma_string(self, lemma):
+        """resolves a lemma hash to its string, which the wordnet lookup needs"""
+
+        if lemma in self.nlp.vocab.strings:
+            return self.nlp.vocab.strings[lemma]
+
+        string = self.cache.get_string(lemma) if self.cache is not None else None
+        if string is None:
+            raise KeyError(f"Unknown lemma hash {lemma}, use a synonym table or rebuild the document cache with preprocess.py")
+        return string
 
 
     def modified_ngrams(self, ngram):
@@ -100,14 +159,9 @@ class ModifiedNgramSimilarity():
         # synonyms
         synprot = []
         for t in ngram:
-            if t.pos_ in ["NOUN", "VERB", "ADJ", "ADV"]:
-                if not (t.lemma_, t.pos_) in self.synset_cache:
-                    self.synset_cache[(t.lemma_, t.pos_)] = self.get_lemma_synset(t)
-                ss = self.synset_cache[(t.lemma_, t.pos_)]
-                if ss:
-                    synprot.append([spacy_hash_string(l) for l in ss])
-                else:
-                    synprot.append(t.lemma)
+            ss = self.synonym_hashes(t)
+            if ss:
+                synprot.append(ss)
             else:
                 synprot.append(t.lemma)
         
@@ -128,13 +182,18 @@ class ModifiedNgramSimilarity():
             yield tuple(t.lemma for t in ngram)
 
 
+    def counter(self, seq):
+        """returns a Counter of a sequence of ngrams, cached by the content of the sequence"""
+
+        key = ("counter", len(seq), hash(tuple(seq)))
+        return self.memory.get_or_compute(key, Counter, seq)
+
+
     def exp_count(self, ngram, doc):
         mod = self.modified_ngrams(ngram)
-        
-        if not id(doc) in self.counter_cache:
-            self.counter_cache[id(doc)] = Counter(doc)
-        acount = self.counter_cache[id(doc)]
-        
+
+        acount = doc if isinstance(doc, Counter) else self.counter(doc)
+
         result = 0
 
         for modgram in mod:
@@ -149,12 +208,11 @@ class ModifiedNgramSimilarity():
         total_contain = 0
         total_bcount = 0
 
-        if not id(bngrams_lemma) in self.counter_cache:
-            self.counter_cache[id(bngrams_lemma)] = Counter(bngrams_lemma)
-        bcount_lemma = self.counter_cache[id(bngrams_lemma)]
+        acount = self.counter(angrams)
+        bcount_lemma = self.counter(bngrams_lemma)
 
         for ngram, ngram_lemma in zip(bngrams, bngrams_lemma):
-            total_contain += min(self.exp_count(ngram, angrams), bcount_lemma[ngram_lemma])
+            total_contain += min(self.exp_count(ngram, acount), bcount_lemma[ngram_lemma])
             total_bcount += bcount_lemma[ngram_lemma]
         if total_bcount != 0:
             return total_contain / total_bcount
@@ -162,13 +220,137 @@ class ModifiedNgramSimilarity():
             return 0
 
 
+    def text_arrays(self, text):
+        """returns the TokenArrays of a text, parsing it only if it is not in the document cache"""
+
+        if self.cache is not None:
+            entry = self.cache.get(text)
+            if entry is not None:
+                count("doc_cache.hits")
+                return TokenArrays(entry.lemmas, entry.pos, entry.offsets)
+            count("doc_cache.misses")
+
+        with stage("spacy"):
+            return doc_arrays(self.nlp(text))
+
+
+    def text_lemmas(self, text):
+        """returns the lemma hashes of a text, reusing the document cache if one is set"""
+
+        return self.text_arrays(text).lemmas.tolist()
+
+
+    def expand_arrays(self, arrays):
+        """precomputes the Expansion of a text B given as TokenArrays"""
+
+        lemmas = np.asarray(arrays.lemmas, dtype='uint64')
+
+        if self.synonyms is not None:
+            options, offsets = self.synonyms.options(lemmas, arrays.pos)
+            return Expansion(lemmas, options, offsets)
+
+        lengths = np.zeros(len(lemmas), dtype='int64')
+        options = []
+
+        for i, (lemma, pos) in enumerate(zip(lemmas.tolist(), arrays.pos.tolist())):
+            ss = self.lemma_synonym_hashes(lemma, POS_NAMES.get(pos))
+            opts = ss if ss else [lemma]
+            options.extend(opts)
+            lengths[i] = len(opts)
+
+        offsets = np.zeros(len(lemmas) + 1, dtype='int64')
+        np.cumsum(lengths, out=offsets[1:])
+
+        return Expansion(lemmas, np.array(options, dtype='uint64'), offsets)
+
+
+    def expand_doc(self, doc):
+        """precomputes the Expansion of a parsed text B"""
+
+        return self.expand_arrays(doc_arrays(doc))
+
+
+    def text_expansion(self, text):
+        def expansion():
+            arrays = self.text_arrays(text)
+            with stage("mngs.expansion"):
+                return self.expand_arrays(arrays)
+
+        key = ("expansion", DocumentCache.key(text))
+        return self.memory.get_or_compute(key, expansion)
+
+
+    def text_acounts(self, text, ngram_length=5):
+        """counts of all ngrams of a text A with len 1 to ngram_length, as sorted unique hashes and counts"""
+
+        def acounts():
+            lemmas = self.text_lemmas(text)
+            with stage("mngs.acounts"):
+                return {n: np.unique(ngram_hashes(lemmas, n), return_counts=True) for n in range(1, ngram_length+1)}
+
+        key = ("acounts", DocumentCache.key(text), ngram_length)
+        return self.memory.get_or_compute(key, acounts)
+
+
+    def mod_containment_scores(self, acounts, expansion, ngram_length=5):
+        """Computes the same scores as mod_containment_score for every ngram length at once.
+
+        exp_count of an ngram of B is the count of its lemma ngram in A plus the counts of all
+        variants in the product of its lemma options. The skipgrams built by modified_ngrams
+        are tuples of ngrams and never match an ngram of A, so they do not contribute."""
+
+        expanded = expanded_counts(expansion, acounts, ngram_length)
+        scores = dict()
+
+        for n in range(1, ngram_length+1):
+            bgrams = ngram_hashes(expansion.lemmas, n)
+
+            if len(bgrams) == 0:
+                scores[f"{n}_mod"] = 0
+                continue
+
+            _, inverse, bcounts = np.unique(bgrams, return_inverse=True, return_counts=True)
+            bcount_lemma = bcounts[inverse]
+            exp_count = lookup_counts(acounts[n], bgrams) + expanded[n]
+
+            total_contain = int(np.minimum(exp_count, bcount_lemma).sum())
+            total_bcount = int(bcount_lemma.sum())
+            scores[f"{n}_mod"] = total_contain / total_bcount
+
+        return scores
+
+
+    def score_arrays(self, arraysa, arraysb, ngram_length=5):
+        """scores two documents given as TokenArrays"""
+
+        lemmas = arraysa.lemmas
+        acounts = {n: np.unique(ngram_hashes(lemmas, n), return_counts=True) for n in range(1, ngram_length+1)}
+        return self.mod_containment_scores(acounts, self.expand_arrays(arraysb), ngram_length)
+
+
     def score_texts(self, texta, textb, ngram_length=5):
         """scores two texts with different ngram-containment-metrics"""
 
-        doca_lemma = [t.lemma for t in self.nlp(texta)] # texta only needs to be in lemma form
+        return self.mod_containment_scores(self.text_acounts(texta, ngram_length), self.text_expansion(textb), ngram_length)
+
+
+    def score_text_batch(self, texta, textbs, ngram_length=5):
+        """scores one text against many texts, reusing the ngram counts of texta"""
+
+        acounts = self.text_acounts(texta, ngram_length)
+        expansions = [self.text_expansion(textb) for textb in textbs]
+
+        with stage("mngs.score"):
+            return [self.mod_containment_scores(acounts, expansion, ngram_length) for expansion in expansions]
+
+
+    def score_texts_reference(self, texta, textb, ngram_length=5):
+        """scores two texts with the original per-ngram implementation, slow but useful for checking score_texts"""
+
+        doca_lemma = self.text_lemmas(texta) # texta only needs to be in lemma form
 
         docb = list(self.nlp(textb))
-        docb_lemma = [t.lemma for t in self.nlp(textb)]
+        docb_lemma = [t.lemma for t in docb]
 
         seqs = dict()
         scores = dict()
@@ -182,5 +364,5 @@ class ModifiedNgramSimilarity():
 
         for key, (b, b_lemma) in seqs.items():
             scores[key] = self.mod_containment_score(acat, b, b_lemma)
-        
+
         return scores
@@ -0,0 +1,141 @@
+"""
+Inverted index from lemma ngrams to source documents, used to prune the sources x texts
+cross join down to candidate pairs that share a minimum number of ngrams.
+Run as a script to report the recall of the pruning against the METER ground truth.
+"""
+
+import sqlite3
+import argparse
+import time
+
+from pathlib import Path
+from collections import Counter, defaultdict
+
+from ngram_similarity import NgramSimilarity
+from doc_cache import DocumentCache
+
+
+class NgramIndex():
+
+    def __init__(self, n=5):
+        self.n = n
+        self.postings = defaultdict(list)
+        self.ndocs = 0
+
+    def add(self, id, sets):
+        """adds the ngrams of a document as returned by NgramSimilarity.make_sets"""
+
+        for gram in sets[self.n].tolist():
+            self.postings[gram].append(id)
+        self.ndocs += 1
+
+    def overlaps(self, sets):
+        """counts the shared ngrams between a document and all indexed documents"""
+
+        counts = Counter()
+        for gram in sets[self.n].tolist():
+            postings = self.postings.get(gram)
+            if postings:
+                counts.update(postings)
+        return counts
+
+    def candidates(self, sets, min_overlap=1):
+        """returns the ids of indexed documents sharing at least min_overlap ngrams"""
+
+        return [id for id, count in self.overlaps(sets).items() if count >= min_overlap]
+
+
+def candidate_pairs(con, scorer, n=5, min_overlap=1):
+    """yields (source id, text id) pairs of a database that share at least min_overlap ngrams of length n"""
+
+    index = NgramIndex(n)
+
+    for id, text in con.execute("SELECT id, text FROM sources").fetchall():
+        index.add(id, scorer.text_sets(text, n))
+
+    for idb, text in con.execute("SELECT id, text FROM texts"):
+        for ida in index.candidates(scorer.text_sets(text, n), min_overlap):
+            yield (ida, idb)
+
+
+def store_candidates(con, pairs):
+    """stores candidate pairs in a temporary table so they can be joined with sources and texts"""
+
+    con.execute("DROP TABLE IF EXISTS temp.candidates")
+    con.execute("CREATE TEMP TABLE candidates (ida, idb, PRIMARY KEY (ida, idb))")
+    con.executemany("INSERT OR IGNORE INTO temp.candidates VALUES (?, ?)", pairs)
+    con.commit()
+
+    return con.execute("SELECT COUNT(*) FROM temp.candidates").fetchone()[0]
+
+
+def has_ground_truth(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='ground_truth'").fetchone() is not None
+
+
+def candidate_recall(con):
+    """computes the share of ground truth pairs per label that are contained in temp.candidates"""
+
+    sql = """
+    SELECT
+        ground_truth.label,
+        COUNT(*),
+        COUNT(candidates.ida)
+    FROM
+        ground_truth
+    LEFT JOIN
+        temp.candidates AS candidates
+    ON
+        ground_truth.ida = candidates.ida AND ground_truth.idb = candidates.idb
+    GROUP BY
+        ground_truth.label
+    """
+
+    return {label: (kept, total) for label, total, kept in con.execute(sql)}
+
+
+def print_recall(recall):
+    for label, (kept, total) in sorted(recall.items()):
+        print(f"\t{label}: {kept}/{total} ground truth pairs kept ({kept / total if total else 0:.4f})")
+
+    reuse = [v for label, v in recall.items() if label != "nd"]
+    kept = sum(k for k, _ in reuse)
+    total = sum(t for _, t in reuse)
+    print(f"\tRecall of reuse pairs: {kept}/{total} ({kept / total if total else 0:.4f})")
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", dest="indb", required=True,
+        help="Path to the input SQLite DB with a ground_truth table", type=Path)
+    argparser.add_argument("-c", dest="cachedb", type=Path,
+        help="Path to a document cache DB created by preprocess.py")
+    argparser.add_argument("-l", default="en", dest="language",
+        help="Language of the documents")
+    argparser.add_argument("-n", default=5, type=int, dest="ngram_length",
+        help="Length of the indexed ngrams")
+    argparser.add_argument("--min-overlap", default=1, type=int, dest="min_overlap",
+        help="Minimum number of shared ngrams for a candidate pair")
+
+    args = argparser.parse_args()
+
+    con = sqlite3.connect(args.indb)
+
+    cache = DocumentCache(args.cachedb, args.language) if args.cachedb else None
+    scorer = NgramSimilarity(args.language, cache=cache)
+
+    st = time.time()
+
+    ncandidates = store_candidates(con, candidate_pairs(con, scorer, args.ngram_length, args.min_overlap))
+    nsources, = con.execute("SELECT COUNT(*) FROM sources").fetchone()
+    ntexts, = con.execute("SELECT COUNT(*) FROM texts").fetchone()
+
+    print(f"{ncandidates} of {nsources * ntexts} pairs are candidates (found in {time.time() - st} s)")
+
+    if has_ground_truth(con):
+        print_recall(candidate_recall(con))
+
+    con.close()
+
+if __name__ == "__main__":
+    main()
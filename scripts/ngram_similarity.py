@@ -1,60 +1,145 @@
-import spacy
 import numpy as np
 
-from nltk.util import ngrams
+from tokenizer import load_pipeline, doc_arrays, ngram_view, TokenArrays
+from instrumentation import stage, count
+
+FNV_OFFSET = np.uint64(14695981039346656037)
+FNV_PRIME = np.uint64(1099511628211)
+
+
+def ngram_hashes(lemmas, n):
+    """encodes every ngram of length n of a lemma hash array as a single uint64.
+    The hash is built incrementally (FNV-1a over whole lemma hashes), so the hash of
+    an ngram can be extended to the hash of any longer ngram it is a prefix of."""
+
+    view = ngram_view(np.asarray(lemmas, dtype='uint64'), n)
+
+    hashes = np.full(len(view), FNV_OFFSET, dtype='uint64')
+    for k in range(n):
+        hashes = extend_hashes(hashes, view[:, k])
+    return hashes
+
+
+def extend_hashes(hashes, lemmas):
+    """appends one lemma to each hashed ngram"""
+
+    return (hashes ^ lemmas) * FNV_PRIME
+
 
 class NgramSimilarity():
 
-    def __init__(self, language):
-        if language == "de":
-            self.nlp = spacy.load("de_core_news_sm", disable=["parser", "ner"])
-        elif language == "en":
-            self.nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
-        else:
-            raise ValueError(f"Unsupported language {language}")
-        
-        self.nlp.max_length = 2_000_000
+    def __init__(self, language, cache=None):
+        self.nlp = load_pipeline(language)
         self.language = language
+        self.cache = cache
+
+    def text_arrays(self, text):
+        """returns the TokenArrays of a text, parsing it only if it is not in the document cache"""
+
+        if self.cache is not None:
+            entry = self.cache.get(text)
+            if entry is not None:
+                count("doc_cache.hits")
+                return TokenArrays(entry.lemmas, entry.pos, entry.offsets)
+            count("doc_cache.misses")
 
-    def make_sets(self, tokens, n=5):
+        with stage("spacy"):
+            return doc_arrays(self.nlp(text))
+
+    def lemmatize(self, text):
+        """returns the lemma hashes of a text"""
+
+        return self.text_arrays(text).lemmas
+
+    def make_sets(self, lemmas, n=5):
         """creation of different sets per text:
-        sets of ngrams with len 1, 3, 5
+        sets of ngrams with len 1 to n as sorted unique arrays of ngram hashes
         set of hapax legomena"""
 
-        lemmas = [t.lemma for t in tokens]
+        lemmas = np.asarray(lemmas, dtype='uint64')
         sets = dict()
 
-        sets[1] = set(lemmas)
+        for k in range(1, n+1):
+            sets[k] = np.unique(ngram_hashes(lemmas, k))
 
-        if n > 1:
-            for n in range(2, n+1):
-                grams = ngrams(lemmas, n)
-                sets[n] = set(grams)
-
-        unique = np.unique(np.array(lemmas, dtype='uint64'), return_counts=True)
-        sets['hapax'] = set([lemma for lemma, count in zip(*unique) if count == 1])
+        unique, counts = np.unique(lemmas, return_counts=True)
+        sets['hapax'] = unique[counts == 1]
 
         return sets
 
+    def text_sets(self, text, ngram_length=5):
+        """returns the sets of a text, reusing the document cache if one is set"""
+
+        if self.cache is not None:
+            entry = self.cache.get(text)
+            if entry is not None and entry.ngram_length == ngram_length:
+                return entry.sets
+
+        lemmas = self.lemmatize(text)
+        with stage("ngs.sets"):
+            return self.make_sets(lemmas, ngram_length)
+
     def setscore(self, seta, setb):
         """scores two sets of lemmas for their ngram-containment"""
-        
+
         if len(seta) == 0 or len(setb) == 0:
             return 0
 
-        overlap = seta & setb
+        overlap = np.intersect1d(seta, setb, assume_unique=True)
         return len(overlap) / len(setb)
 
-    def score_texts(self, texta, textb, ngram_length=5):
-        """scores two texts with different ngram-containment-metrics"""
-
-        setsa = self.make_sets(self.nlp(texta), ngram_length)
-        setsb = self.make_sets(self.nlp(textb), ngram_length)
+    def score_sets(self, setsa, setsb):
+        """scores two dicts of sets as returned by make_sets"""
 
         scores = dict()
 
         for (akey, a), (bkey, b) in zip(setsa.items(), setsb.items()):
             assert(akey == bkey)
             scores[akey] = self.setscore(a, b)
-        
+
+        return scores
+
+    def score_sets_batch(self, setsa, setsbs):
+        """scores one dict of sets against many at once, returns one scores dict per entry of setsbs"""
+
+        scores = [dict() for _ in setsbs]
+
+        for key, a in setsa.items():
+            bs = [setsb[key] for setsb in setsbs]
+            lengths = np.array([len(b) for b in bs])
+
+            if len(a) == 0 or lengths.sum() == 0:
+                for s in scores:
+                    s[key] = 0
+                continue
+
+            contained = np.isin(np.concatenate(bs), a)
+            segments = np.repeat(np.arange(len(bs)), lengths)
+            overlaps = np.bincount(segments, weights=contained, minlength=len(bs))
+
+            for s, overlap, length in zip(scores, overlaps, lengths):
+                s[key] = int(overlap) / int(length) if length > 0 else 0
+
         return scores
+
+    def score_arrays(self, arraysa, arraysb, ngram_length=5):
+        """scores two documents given as TokenArrays"""
+
+        return self.score_sets(self.make_sets(arraysa.lemmas, ngram_length), self.make_sets(arraysb.lemmas, ngram_length))
+
+    def score_texts(self, texta, textb, ngram_length=5):
+        """scores two texts with different ngram-containment-metrics"""
+
+        setsa = self.text_sets(texta, ngram_length)
+        setsb = self.text_sets(textb, ngram_length)
+
+        return self.score_sets(setsa, setsb)
+
+    def score_text_batch(self, texta, textbs, ngram_length=5):
+        """scores one text against many texts, see score_sets_batch"""
+
+        setsa = self.text_sets(texta, ngram_length)
+        setsbs = [self.text_sets(textb, ngram_length) for textb in textbs]
+
+        with stage("ngs.score"):
+            return self.score_sets_batch(setsa, setsbs)
@@ -3,15 +3,41 @@ import pickle
 import json
 import multiprocessing
 import argparse
+import hashlib
 import time
+import os
 
 from pathlib import Path
-from itertools import islice
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from itertools import islice, groupby
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from copy import deepcopy
 
+import numpy as np
+
 from ngram_similarity import NgramSimilarity
 from modified_ngram_similarity import ModifiedNgramSimilarity
+from doc_cache import DocumentCache
+from ngram_index import candidate_pairs, store_candidates, has_ground_truth, candidate_recall, print_recall
+from minhash import lsh_pairs
+from shards import register_shard_function
+from db_writer import BulkWriter
+from text_store import TextStore
+from score_format import SCORE_DTYPE, metric_names, setup_score_names, read_score_names, score_matrix
+from instrumentation import metrics, stage, enable_profile, MetricsReporter
+from pruning import PairPruner, document_sizes, models_threshold
+
+
+def now():
+    return datetime.now().isoformat()
+
+
+def model_key(modelpath):
+    """identifies a classifier by the hash of its pickle"""
+
+    with Path(modelpath).open(mode="rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
 
 
 def chunk(length, iterator):
@@ -26,39 +52,267 @@ def chunk(length, iterator):
         yield chunk
 
 
+def load_models(modelpaths):
+    models = []
+    for modelpath in modelpaths:
+        with Path(modelpath).open(mode="rb") as f:
+            models.append(pickle.load(f))
+    return models
+
+
+def init_worker(language, inpath, modelpaths, modelkeys, use_mngs, cachepath, synonympath, cache_bytes, instrument=False, profiledir=None):
+    """loads spaCy, GermaNet (or the synonym table) and the classifiers once per worker process"""
+
+    global store
+    global scorer
+    global models
+    global model_keys
+    global mngs_scorer
+    global caches
+
+    metrics.enabled = instrument
+    if profiledir:
+        enable_profile(profiledir, "worker")
+
+    # workers only get pair ids and read the texts from the input DB themselves
+    store = TextStore(inpath, memory_bytes=cache_bytes)
+    cache = DocumentCache(cachepath, language, memory_bytes=cache_bytes) if cachepath else None
+
+    scorer = NgramSimilarity(language, cache=cache)
+    mngs_scorer = ModifiedNgramSimilarity(language, cache=cache, synonyms=synonympath, cache_bytes=cache_bytes) if use_mngs else None
+
+    models = load_models(modelpaths)
+    model_keys = modelkeys
+
+    caches = {"texts": store.memory}
+    if cache is not None:
+        caches["documents"] = cache.memory
+    if mngs_scorer is not None:
+        caches["mngs"] = mngs_scorer.memory
+
+
+def bounded_map(executor, fn, iterator, window, *args):
+    """submits fn(e, *args) for every element and yields results as soon as they complete,
+    keeping at most window jobs in flight"""
+
+    pending = set()
+
+    for e in iterator:
+        if len(pending) >= window:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                yield f.result()
+        pending.add(executor.submit(fn, e, *args))
+
+    for f in as_completed(pending):
+        yield f.result()
+
+
+def pruned_rows(rows, pruner, writer, run_id, size=10000):
+    """yields the rows that can be labeled as reuse and records the pruned pairs with their bound"""
+
+    for part in chunk(size, rows):
+        with stage("main.prune"):
+            kept, pruned = pruner.split(part)
+            writer.executemany("INSERT OR IGNORE INTO pruned_pairs VALUES (?, ?, ?, ?)", ((*p, run_id) for p in pruned))
+        metrics.count("pairs.pruned", len(pruned))
+        yield from kept
+
+
 def label_rows(rows, use_mngs=False):
-    scores = [scorer.score_texts(texta, textb) for rownum, ida, idb, texta, textb in rows]
+    with stage("worker.bundle"):
+        predictions, labels = score_rows(rows, use_mngs)
+
+    # timings since the last bundle and the cumulative cache stats of this worker
+    report = (os.getpid(), metrics.collect(), {name: c.stats() for name, c in caches.items()}) if metrics.enabled else None
+
+    return predictions, labels, report
+
+
+def score_rows(rows, use_mngs=False):
+    scores = []
+    # rows come grouped by source, so each source is scored against its texts in one batch
+    for ida, group in groupby(rows, key=itemgetter(1)):
+        with stage("fetch"):
+            texta = store.text("sources", ida)
+            textbs = store.texts("texts", [idb for _, _, idb in group])
 
-    if use_mngs:
-        scores2 = [mngs_scorer.score_texts(texta, textb) for rownum, ida, idb, texta, textb in rows]
-        scores = [{**a, **b} for a, b in zip(scores, scores2)]
+        groupscores = scorer.score_text_batch(texta, textbs)
 
-    rawscores = [list(s.values()) for s in scores]
-    labels = model.predict(rawscores)
-    return [(ida, idb, json.dumps(score), str(label)) for (_, ida, idb, _, _), score, label in zip(rows, scores, labels)]
+        if use_mngs:
+            groupscores2 = mngs_scorer.score_text_batch(texta, textbs)
+            groupscores = [{**a, **b} for a, b in zip(groupscores, groupscores2)]
+
+        scores.extend(groupscores)
+
+    features = np.array([list(s.values()) for s in scores], dtype=SCORE_DTYPE)
+    with stage("predict"):
+        labels = [model.predict(features) for model in models]
+
+    ids = [(ida, idb) for _, ida, idb in rows]
+    predictions = [(ida, idb, f.tobytes(), str(label)) for (ida, idb), f, label in zip(ids, features, labels[0])]
+    return predictions, model_labels(ids, model_keys, labels)
+
+
+def model_labels(ids, modelkeys, labels):
+    """rows of the model_labels table, only written if more than one model is applied"""
+
+    if len(modelkeys) < 2:
+        return []
+    return [(ida, idb, key, str(label)) for key, modellabels in zip(modelkeys, labels) for (ida, idb), label in zip(ids, modellabels)]
+
+
+def rescore(con, models, modelkeys, bundlesize):
+    """re-applies classifiers to the stored scores of all predictions, returns the number of pairs.
+    The first model labels the predictions table, all of them the model_labels table if there are several."""
+
+    nnames = len(read_score_names(con))
+    for model, key in zip(models, modelkeys):
+        nfeatures = getattr(model, "n_features_in_", None)
+        if nfeatures is not None and nnames and nfeatures != nnames:
+            raise ValueError(f"Model {key} expects {nfeatures} scores, but the predictions have {nnames}")
+
+    npairs = 0
+    lastrow = -1
+
+    while True:
+        rows = con.execute(
+            "SELECT rowid, ida, idb, scores FROM predictions WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (lastrow, bundlesize)
+        ).fetchall()
+        if not rows:
+            break
+
+        features = score_matrix(scores for _, _, _, scores in rows)
+        labels = [model.predict(features) for model in models]
+
+        con.executemany(
+            "UPDATE predictions SET label=? WHERE rowid=?",
+            ((str(label), rowid) for (rowid, _, _, _), label in zip(rows, labels[0]))
+        )
+        con.executemany(
+            "INSERT OR REPLACE INTO model_labels VALUES (?, ?, ?, ?)",
+            model_labels([(ida, idb) for _, ida, idb, _ in rows], modelkeys, labels)
+        )
+        con.commit()
+
+        npairs += len(rows)
+        lastrow = rows[-1][0]
+
+    return npairs
+
+
+def fan_out_sql(indb):
+    """script copying the predictions, labels and pruned pairs of canonical documents to their aliases"""
+
+    columns = {
+        "predictions": "scores, label",
+        "model_labels": "model, label",
+        "pruned_pairs": "bound, run_id",
+    }
+
+    inserts = []
+    for table, rest in columns.items():
+        rest = ", ".join(f"{table}.{column}" for column in rest.split(", "))
+        # texts first, so pairs of two aliases are copied from the pairs of the source's canonical document with the text alias
+        inserts.append(f"""
+        INSERT OR IGNORE INTO {table}
+        SELECT {table}.ida, aliases.id, {rest} FROM {table}
+        INNER JOIN input.aliases AS aliases ON aliases.tbl = 'texts' AND aliases.canonical = {table}.idb;
+        INSERT OR IGNORE INTO {table}
+        SELECT aliases.id, {table}.idb, {rest} FROM {table}
+        INNER JOIN input.aliases AS aliases ON aliases.tbl = 'sources' AND aliases.canonical = {table}.ida;""")
+
+    # ATTACH and DETACH have to happen outside of the transaction
+    path = str(indb).replace("'", "''")
+    return f"""
+    ATTACH DATABASE '{path}' AS input;
+    BEGIN;
+    {"".join(inserts)}
+    COMMIT;
+    DETACH DATABASE input;"""
 
 
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument("-o", default=Path("predictions.db"), dest="outdb",
         help="Path to the output SQLite DB", type=Path)
-    argparser.add_argument("-i", dest="indb", required=True,
-        help="Path to the input SQLite DB", type=Path)
-    argparser.add_argument("-m", dest="modelpath", required=True,
-        help="Path to the pickled ScikitLearn model to use", type=Path)
+    argparser.add_argument("-i", dest="indb",
+        help="Path to the input SQLite DB, required unless --rescore is given", type=Path)
+    argparser.add_argument("-m", dest="modelpaths", required=True, nargs="+",
+        help="Paths to the pickled ScikitLearn models to use. The scores are computed once, "
+             "the first model labels the predictions table and all models the model_labels table", type=Path)
     argparser.add_argument("-t", default=multiprocessing.cpu_count(), type=int, dest="njobs",
         help="Sets the number of parallell processes to use. Defaults to all available")
+    argparser.add_argument("-b", default=1000, type=int, dest="bundlesize",
+        help="Number of pairs per work bundle")
+    argparser.add_argument("-w", type=int, dest="window",
+        help="Maximum number of work bundles in flight. Defaults to twice the number of processes")
     argparser.add_argument("-s", type=int, dest="start",
-        help="Start of range for DB rows to process (inclusive)")
+        help="Start of range for pairs to process (inclusive), pairs are numbered ordered by source and text id")
     argparser.add_argument("-e", type=int, dest="end",
-        help="End of range for DB rows to process (exclusive)")
+        help="End of range for pairs to process (exclusive)")
+    argparser.add_argument("--resume", default=False, action='store_true', dest="resume",
+        help="Skip pairs that already have a prediction in the output DB")
+    argparser.add_argument("--shards", type=int, dest="nshards",
+        help="Split the pairs into this many deterministic shards, see shards.py")
+    argparser.add_argument("--shard", type=int, dest="shard",
+        help="Index of the shard to process, used with --shards")
+    argparser.add_argument("--incremental", default=False, action='store_true', dest="incremental",
+        help="Only score new sources against all texts and all sources against new texts, "
+             "where new means not yet scored with all of the models")
+    argparser.add_argument("--rescore", default=False, action='store_true', dest="rescore",
+        help="Only re-apply the models to the scores already stored in the output DB, without computing any text metrics")
+    argparser.add_argument("--dedup", default=False, action='store_true', dest="dedup",
+        help="Only score canonical documents of the aliases table written by load_own.py or dedup.py "
+             "and copy their predictions to all of their aliases")
     argparser.add_argument("--mngs", default=False, action='store_true', dest="mngs",
         help="Flag for using modified ngram similarity")
+    argparser.add_argument("--synonyms", dest="synonyms", type=Path,
+        help="Path to a synonym table compiled by synonym_table.py, used with --mngs instead of loading GermaNet")
+    argparser.add_argument("-c", dest="cachedb", type=Path,
+        help="Path to a document cache DB created by preprocess.py")
+    argparser.add_argument("--cache-mb", default=256, type=int, dest="cache_mb",
+        help="Memory budget in MB per worker for each in-process document cache")
+    argparser.add_argument("--metrics", default=False, action='store_true', dest="metrics",
+        help="Time the pipeline stages in all processes and store periodic progress records in a metrics table of the output DB")
+    argparser.add_argument("--metrics-file", dest="metrics_file", type=Path,
+        help="Also append the progress records to this JSON lines file, implies --metrics")
+    argparser.add_argument("--metrics-interval", default=30, type=float, dest="metrics_interval",
+        help="Seconds between two progress records")
+    argparser.add_argument("--profile", dest="profiledir", type=Path,
+        help="Write cProfile stats of the main and every worker process into this directory")
+    argparser.add_argument("--prune", default=False, action='store_true', dest="prune",
+        help="Skip pairs whose ngram containment can not be high enough for any of the models to label them as reuse, "
+             "see pruning.py. The skipped pairs are recorded in the pruned_pairs table")
+    argparser.add_argument("--prune-ratio", type=float, dest="prune_ratio",
+        help="Skip pairs whose containment bound is at most this value instead of deriving it from the models, implies --prune")
+    prefilter = argparser.add_mutually_exclusive_group()
+    prefilter.add_argument("--min-overlap", type=int, dest="min_overlap",
+        help="Only score pairs sharing at least this many ngrams. Scores the full cross join if not set")
+    prefilter.add_argument("--lsh-bands", type=int, dest="lsh_bands",
+        help="Only score pairs found by MinHash LSH with this many bands")
+    argparser.add_argument("--lsh-rows", default=5, type=int, dest="lsh_rows",
+        help="Number of rows per LSH band, used with --lsh-bands")
+    argparser.add_argument("--overlap-n", default=5, type=int, dest="overlap_n",
+        help="Ngram length used for candidate pruning with --min-overlap or --lsh-bands")
     
     args = argparser.parse_args()
 
-    incon = sqlite3.connect(args.indb)
-    incur = incon.cursor()
+    if args.indb is None and not args.rescore:
+        argparser.error("-i is required unless --rescore is given")
+
+    args.metrics = args.metrics or args.metrics_file is not None
+    args.prune = args.prune or args.prune_ratio is not None
+    metrics.enabled = args.metrics
+    if args.profiledir:
+        enable_profile(args.profiledir, "main")
+
+    if args.incremental and (args.start or args.end):
+        argparser.error("--incremental can not be combined with -s/-e")
+
+    if (args.nshards is None) != (args.shard is None) or (args.nshards and not 0 <= args.shard < args.nshards):
+        argparser.error("--shards and --shard have to be given together with 0 <= shard < shards")
 
     outcon = sqlite3.connect(args.outdb)
     outcur = outcon.cursor()
@@ -66,87 +320,350 @@ def main():
     CREATE TABLE IF NOT EXISTS predictions (
         ida INTEGER NOT NULL,
         idb INTEGER NOT NULL,
-        scores TEXT,
+        scores BLOB,
         label TEXT,
         FOREIGN KEY(ida) REFERENCES sources(id)
         FOREIGN KEY(idb) REFERENCES texts(id)
         PRIMARY KEY (ida, idb)
     );
+
+    CREATE TABLE IF NOT EXISTS progress (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started TEXT,
+        updated TEXT,
+        finished TEXT,
+        args TEXT,
+        pairs_total INTEGER,
+        pairs_done INTEGER,
+        last_ida,
+        last_idb
+    );
+
+    CREATE TABLE IF NOT EXISTS scored_documents (
+        tbl TEXT NOT NULL,
+        id NOT NULL,
+        model TEXT NOT NULL,
+        run_id INTEGER,
+        PRIMARY KEY (tbl, id, model)
+    );
+
+    CREATE TABLE IF NOT EXISTS models (
+        model TEXT PRIMARY KEY,
+        path TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS model_labels (
+        ida INTEGER NOT NULL,
+        idb INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        label TEXT,
+        PRIMARY KEY (ida, idb, model)
+    );
+
+    CREATE TABLE IF NOT EXISTS pruned_pairs (
+        ida INTEGER NOT NULL,
+        idb INTEGER NOT NULL,
+        bound REAL,
+        run_id INTEGER,
+        PRIMARY KEY (ida, idb)
+    );
     """
-    outcur.execute(setupsql)
-    
-    if args.start or args.end:
-        frags = []
+    outcur.executescript(setupsql)
+
+    outcur.execute(
+        "INSERT INTO progress (started, updated, args, pairs_done) VALUES (?, ?, ?, 0)",
+        (now(), now(), json.dumps(vars(args), default=str))
+    )
+    run_id = outcur.lastrowid
+    outcon.commit()
+
+    modelkeys = [model_key(path) for path in args.modelpaths]
+    outcur.executemany("INSERT OR REPLACE INTO models VALUES (?, ?)", zip(modelkeys, map(str, args.modelpaths)))
+    outcon.commit()
+
+    if args.rescore:
+        st = time.time()
+
+        models = load_models(args.modelpaths)
+        npairs = rescore(outcon, models, modelkeys, args.bundlesize)
 
-        if args.start:
-            frags.append(f"row >= {args.start}")
-        
-        if args.end:
-            frags.append(f"row < {args.end}")
+        # pruned pairs have no scores, the new models might label some of them as reuse
+        nunsafe, = outcur.execute("SELECT COUNT(*) FROM pruned_pairs").fetchone()
+        if nunsafe:
+            threshold = models_threshold(models, read_score_names(outcon))
+            if threshold is not None:
+                nunsafe, = outcur.execute("SELECT COUNT(*) FROM pruned_pairs WHERE bound > ?", (threshold,)).fetchone()
+        if nunsafe:
+            print(f"Warning: {nunsafe} pruned pairs are not safe to skip for these models, score them in a run without --prune")
 
-        sqlwhere = f"WHERE {' AND '.join(frags)}"
+        # every predicted pair is labeled by the new models now
+        for modelkey in modelkeys:
+            outcur.execute(
+                "INSERT OR IGNORE INTO scored_documents SELECT tbl, id, ?, ? FROM scored_documents",
+                (modelkey, run_id)
+            )
+        outcur.execute(
+            "UPDATE progress SET updated=?, finished=?, pairs_total=?, pairs_done=? WHERE run_id=?",
+            (now(), now(), npairs, npairs, run_id)
+        )
+        outcon.commit()
+        outcon.close()
+
+        print(f"Rescored {npairs} pairs in {time.time() - st} s")
+        return
+
+    setup_score_names(outcon, metric_names(args.mngs))
+
+    incon = sqlite3.connect(args.indb)
+    incur = incon.cursor()
+
+    # snapshot of the documents covered by this run, documents added while it runs stay new
+    source_ids = [id for id, in incur.execute("SELECT id FROM sources")]
+    text_ids = [id for id, in incur.execute("SELECT id FROM texts")]
+
+    if args.dedup:
+        if incur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='aliases'").fetchone() is None:
+            argparser.error(f"{args.indb} has no aliases table, run dedup.py first")
+
+        # temporary views shadow the document tables, so all pair queries below only see canonical documents
+        for table in ["sources", "texts"]:
+            incon.execute(f"DROP VIEW IF EXISTS temp.{table}")
+            incon.execute(
+                f"""CREATE TEMP VIEW {table} AS
+                SELECT * FROM main.{table} WHERE id NOT IN (SELECT id FROM main.aliases WHERE tbl='{table}')"""
+            )
+        nsources, = incur.execute("SELECT COUNT(*) FROM sources").fetchone()
+        ntexts, = incur.execute("SELECT COUNT(*) FROM texts").fetchone()
+        print(f"Scoring {nsources} of {len(source_ids)} sources and {ntexts} of {len(text_ids)} texts, the others are duplicates")
+
+    cache = DocumentCache(args.cachedb, "de") if args.cachedb else None
+
+    if args.prune:
+        threshold = args.prune_ratio
+        if threshold is None:
+            threshold = models_threshold(load_models(args.modelpaths), metric_names(args.mngs))
+        if threshold is None:
+            argparser.error("No pruning bound can be derived for these models, give one with --prune-ratio")
+
+    if args.min_overlap is not None or args.lsh_bands:
+        pst = time.time()
+        scorer = NgramSimilarity("de", cache=cache)
+        if args.lsh_bands:
+            pairs = lsh_pairs(incon, scorer, args.lsh_bands, args.lsh_rows, args.overlap_n)
+        else:
+            pairs = candidate_pairs(incon, scorer, args.overlap_n, args.min_overlap)
+        ncandidates = store_candidates(incon, pairs)
+        print(f"Found {ncandidates} candidate pairs in {time.time() - pst} s")
+
+        if has_ground_truth(incon):
+            print_recall(candidate_recall(incon))
+
+        sqlpairs = "SELECT ida, idb FROM temp.candidates"
     else:
-        sqlwhere = ""
+        sqlpairs = "SELECT sources.id AS ida, texts.id AS idb FROM sources CROSS JOIN texts"
+
+    if args.incremental:
+        incon.execute("ATTACH DATABASE ? AS out", (str(args.outdb),))
+        for table in ["sources", "texts"]:
+            incon.execute(f"DROP TABLE IF EXISTS temp.scored_{table}")
+            # a document is only old if it was scored with every model of this run
+            incon.execute(
+                f"""CREATE TEMP TABLE scored_{table} AS
+                SELECT id FROM out.scored_documents
+                WHERE tbl=? AND model IN ({", ".join("?" * len(modelkeys))})
+                GROUP BY id HAVING COUNT(DISTINCT model)=?""",
+                (table, *modelkeys, len(modelkeys))
+            )
+            incon.execute(f"CREATE UNIQUE INDEX temp.scored_{table}_ids ON scored_{table} (id)")
+        incon.commit()
+        incon.execute("DETACH DATABASE out")
 
+        newsources, = incon.execute("SELECT COUNT(*) FROM sources WHERE id NOT IN temp.scored_sources").fetchone()
+        newtexts, = incon.execute("SELECT COUNT(*) FROM texts WHERE id NOT IN temp.scored_texts").fetchone()
+        print(f"Incremental run with {newsources} new sources and {newtexts} new texts")
+
+        if args.min_overlap is not None or args.lsh_bands:
+            sqlpairs = f"""
+            SELECT ida, idb FROM ({sqlpairs})
+            WHERE ida NOT IN temp.scored_sources OR idb NOT IN temp.scored_texts"""
+        else:
+            # (new sources x all texts) + (old sources x new texts)
+            sqlpairs = """
+            SELECT sources.id AS ida, texts.id AS idb
+            FROM sources CROSS JOIN texts
+            WHERE sources.id NOT IN temp.scored_sources
+            UNION ALL
+            SELECT sources.id AS ida, texts.id AS idb
+            FROM sources CROSS JOIN texts
+            WHERE sources.id IN temp.scored_sources AND texts.id NOT IN temp.scored_texts"""
+
+    frags = []
+
+    if args.start:
+        frags.append(f"row >= {args.start}")
+
+    if args.end:
+        frags.append(f"row < {args.end}")
+
+    if args.nshards:
+        register_shard_function(incon)
+        frags.append(f"shard_of(pairs.ida, pairs.idb, {args.nshards}) = {args.shard}")
+
+    if args.resume:
+        incon.execute("ATTACH DATABASE ? AS out", (str(args.outdb),))
+        incon.execute("DROP TABLE IF EXISTS temp.done")
+        incon.execute("CREATE TEMP TABLE done AS SELECT ida, idb FROM out.predictions UNION SELECT ida, idb FROM out.pruned_pairs")
+        incon.execute("CREATE UNIQUE INDEX temp.done_pairs ON done (ida, idb)")
+        incon.commit()
+        incon.execute("DETACH DATABASE out")
+
+        ndone, = incon.execute("SELECT COUNT(*) FROM temp.done").fetchone()
+        print(f"Resuming, skipping {ndone} already predicted or pruned pairs")
+
+        frags.append("NOT EXISTS (SELECT 1 FROM temp.done WHERE done.ida = pairs.ida AND done.idb = pairs.idb)")
+
+    sqlwhere = f"WHERE {' AND '.join(frags)}" if frags else ""
+
+    # pairs are numbered in a deterministic order, so row ranges are stable between runs.
+    # Only ids are streamed, the workers read the texts themselves
     sqlselect = f"""
-    SELECT * FROM (
-        SELECT 
-            ROW_NUMBER () OVER () row,
-            sources.id,
-            texts.id,
-            sources.text,
-            texts.text
-        FROM
-            sources
-        CROSS JOIN
-            texts
-    )
+    SELECT
+        pairs.row,
+        pairs.ida,
+        pairs.idb
+    FROM (
+        SELECT
+            ROW_NUMBER () OVER (ORDER BY ida, idb) row,
+            ida,
+            idb
+        FROM ({sqlpairs})
+    ) AS pairs
+    {sqlwhere}
+    ORDER BY
+        pairs.row;
+    """
+
+    sqlcount = f"""
+    SELECT COUNT(*) FROM (
+        SELECT
+            ROW_NUMBER () OVER (ORDER BY ida, idb) row,
+            ida,
+            idb
+        FROM ({sqlpairs})
+    ) AS pairs
     {sqlwhere};
     """
 
+    npending, = incur.execute(sqlcount).fetchone()
+
     rowiter = incur.execute(sqlselect)
 
     print(sqlselect)
 
-    global scorer
-    global model
-    global mngs_scorer
+    outcur.execute("UPDATE progress SET pairs_total=? WHERE run_id=?", (npending, run_id))
+    outcon.commit()
+    outcon.close()
 
-    if args.mngs:
-         mngs_scorer = ModifiedNgramSimilarity("de")
-    else:
-        mngs_scorer = None
+    # from here on all writes go through the writer thread, the index for selecting
+    # matches by label is only built once all predictions are written
+    writer = BulkWriter(args.outdb)
+    writer.defer("CREATE INDEX IF NOT EXISTS predictions_label ON predictions (label)")
+
+    print(f"{npending} pairs to process")
 
-    scorer = NgramSimilarity("de")
+    if args.prune:
+        pst = time.time()
+        scorer = NgramSimilarity("de", cache=cache)
+        pruner = PairPruner(threshold, document_sizes(incon, scorer, "sources"), document_sizes(incon, scorer, "texts"))
+        rowiter = pruned_rows(rowiter, pruner, writer, run_id)
+        print(f"Pruning pairs with a containment bound <= {threshold}, set sizes computed in {time.time() - pst} s")
 
-    with args.modelpath.open(mode="rb") as f:
-        model = pickle.load(f)
+    window = args.window or 2 * args.njobs
+    initargs = (
+        "de",
+        str(args.indb),
+        [str(path) for path in args.modelpaths],
+        modelkeys,
+        args.mngs,
+        str(args.cachedb) if args.cachedb else None,
+        str(args.synonyms) if args.synonyms else None,
+        args.cache_mb * 2**20,
+        args.metrics,
+        str(args.profiledir) if args.profiledir else None
+    )
+
+    reporter = MetricsReporter(npending, args.njobs, args.metrics_interval, args.metrics_file, writer, run_id) if args.metrics else None
 
     st = time.time()
+    npairs = 0
 
-    for num, batch in enumerate(chunk(args.njobs, chunk(1000, rowiter)), 1):
-        with ProcessPoolExecutor(max_workers = args.njobs) as executor:
-            print(f"Processing batch {num} after {time.time()-st} s")
+    with ProcessPoolExecutor(max_workers = args.njobs, initializer = init_worker, initargs = initargs) as executor:
+        bundles = bounded_map(executor, label_rows, chunk(args.bundlesize, rowiter), window, args.mngs)
 
-            bst = time.time()
-            jobs = []
+        num = 0
+        while True:
+            # time spent waiting for workers, including the transfer of their results
+            with stage("main.wait"):
+                bundle = next(bundles, None)
+            if bundle is None:
+                break
 
-            for workbundle in batch:
-                print(f"\tSubmitting workbundle starting with row {workbundle[0][0]}")
-                
-                job = executor.submit(label_rows, workbundle, args.mngs)
-                jobs.append(job)
+            results, labels, report = bundle
+            npairs += len(results)
+            num += 1
 
-            bundleresults = [f.result() for f in as_completed(jobs)]
-            for results in bundleresults:
-                outcur.executemany("INSERT OR IGNORE INTO predictions VALUES(?, ?, ?, ?)", results);
-                outcon.commit()
+            # predictions and progress are committed together, so a killed run can be resumed from here
+            with stage("main.write"):
+                writer.executemany("INSERT OR IGNORE INTO predictions VALUES(?, ?, ?, ?)", results)
+                writer.executemany("INSERT OR IGNORE INTO model_labels VALUES(?, ?, ?, ?)", labels)
+                writer.execute(
+                    "UPDATE progress SET updated=?, pairs_done=?, last_ida=?, last_idb=? WHERE run_id=?",
+                    (now(), npairs, results[-1][0], results[-1][1], run_id)
+                )
+                writer.commit()
 
-            print(f"Processed batch {num} in {time.time() - bst} s")
+            if reporter is not None:
+                reporter.update(*report[1:], pid=report[0])
+                if reporter.due():
+                    reporter.update(metrics.collect())
+                    reporter.emit(npairs)
 
-    incon.close()
+            if num % args.njobs == 0:
+                elapsed = time.time() - st
+                nprocessed = npairs + (pruner.pruned if args.prune else 0)
+                rate = nprocessed / elapsed
+                eta = (npending - nprocessed) / rate if rate else 0
+                print(f"Processed {nprocessed}/{npending} pairs after {elapsed} s ({rate} pairs/s, ETA {eta:.0f} s)")
 
-    outcon.close()
+    if reporter is not None:
+        reporter.update(metrics.collect())
+        record = reporter.emit(npairs)
+        for name, timing in record["stages"].items():
+            print(f"\t{name}: {timing['seconds']:.2f} s in {timing['calls']} calls")
+
+    if args.prune:
+        print(f"Pruned {pruner.pruned} of {pruner.pruned + npairs} pairs")
+
+    if args.dedup:
+        writer.executescript(fan_out_sql(args.indb))
+
+    writer.execute("UPDATE progress SET finished=? WHERE run_id=?", (now(), run_id))
+
+    # only runs over the whole pair space (or a whole shard of it) mark their documents as scored
+    if not (args.start or args.end):
+        for modelkey in modelkeys:
+            writer.executemany(
+                "INSERT OR IGNORE INTO scored_documents VALUES ('sources', ?, ?, ?)",
+                ((id, modelkey, run_id) for id in source_ids)
+            )
+            writer.executemany(
+                "INSERT OR IGNORE INTO scored_documents VALUES ('texts', ?, ?, ?)",
+                ((id, modelkey, run_id) for id in text_ids)
+            )
+
+    writer.close()
+
+    incon.close()
 
     print(f"Completed in {time.time() - st} s")
 
@@ -0,0 +1,80 @@
+"""
+This script tokenizes and lemmatizes every document of an input database once and stores
+the lemma hashes, POS ids and ngram sets in a document cache, so that the inference scripts
+do not have to run spaCy on the same text for every pair it is part of. Documents are parsed
+in batches with nlp.pipe, optionally spread over several processes.
+"""
+
+import sqlite3
+import argparse
+import time
+
+from pathlib import Path
+
+from ngram_similarity import NgramSimilarity
+from doc_cache import DocumentCache
+from tokenizer import pipe_arrays
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", dest="indb", required=True,
+        help="Path to the input SQLite DB", type=Path)
+    argparser.add_argument("-c", default=Path("cache.db"), dest="cachedb",
+        help="Path to the document cache SQLite DB", type=Path)
+    argparser.add_argument("-l", default="de", dest="language",
+        help="Language of the documents")
+    argparser.add_argument("-n", default=5, type=int, dest="ngram_length",
+        help="Maximum ngram length to precompute sets for")
+    argparser.add_argument("-b", default=64, type=int, dest="batch_size",
+        help="Number of documents spaCy parses per batch")
+    argparser.add_argument("-p", default=1, type=int, dest="processes",
+        help="Number of processes spaCy parses with")
+
+    args = argparser.parse_args()
+
+    incon = sqlite3.connect(args.indb)
+    incur = incon.cursor()
+
+    cache = DocumentCache(args.cachedb, args.language)
+    scorer = NgramSimilarity(args.language)
+
+    st = time.time()
+
+    for table in ["sources", "texts"]:
+        parsed = 0
+        skipped = 0
+
+        def uncached():
+            # cached texts only need their id mapping, everything else is streamed through spaCy
+            nonlocal skipped
+            for id, text in incur.execute(f"SELECT id, text FROM {table}"):
+                if text in cache:
+                    cache.put_id(table, id, text, commit=False)
+                    skipped += 1
+                else:
+                    yield text, (id, text)
+
+        for arrays, doc, (id, text) in pipe_arrays(scorer.nlp, uncached(), args.batch_size, args.processes):
+            cache.put(text, arrays, scorer.make_sets(arrays.lemmas, args.ngram_length), args.ngram_length, commit=False)
+            cache.put_id(table, id, text, commit=False)
+
+            # lemma strings are needed for live wordnet lookups on cached documents
+            strings = doc.vocab.strings
+            cache.put_strings({h: strings[h] for h in set(arrays.lemmas.tolist())}, commit=False)
+
+            parsed += 1
+            if parsed % 1000 == 0:
+                cache.commit()
+                print(f"\t{table}: {parsed} documents parsed after {time.time()-st} s")
+
+        cache.commit()
+        print(f"Preprocessed {table}: {parsed} parsed, {skipped} already cached")
+
+    incon.close()
+    cache.close()
+
+    print(f"Completed in {time.time() - st} s")
+
+if __name__ == "__main__":
+    main()
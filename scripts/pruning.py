@@ -0,0 +1,314 @@
+"""
+Upper bounds on the containment scores of a pair from the set sizes of its documents, used to
+skip pairs before scoring that can not be labeled as reuse. The containment of B in A is
+|A_n & B_n| / |B_n| <= min(1, |A_n| / |B_n|) for every ngram length n and the hapax legomena,
+so e.g. a short source can only contain a small part of a long text. For tree ensembles the
+largest bound at which the classifier still labels a pair as negative, whatever its other
+scores are, is derived from the fitted trees.
+Run as a script to validate the pruning against the METER ground truth.
+"""
+
+import sqlite3
+import argparse
+import pickle
+import sys
+import time
+
+from pathlib import Path
+
+import numpy as np
+
+from ngram_similarity import NgramSimilarity
+from doc_cache import DocumentCache
+from ngram_index import has_ground_truth, print_recall
+from score_format import SCORE_DTYPE, metric_names, read_score_names, read_scores
+
+# labels of the negative class of the multiclass and the binary METER models
+NEGATIVE_LABELS = ["nd", 0, "0", False]
+
+
+def set_sizes(sets):
+    """sizes of the sets as returned by make_sets, in the order of the scores"""
+
+    return np.array([len(s) for s in sets.values()], dtype='int64')
+
+
+def document_sizes(con, scorer, tbl, n=5):
+    """returns the set sizes of all documents of a table by id, taking them from the scorer's document cache if possible"""
+
+    cache = scorer.cache
+    sizes = dict()
+
+    for id, text in con.execute(f"SELECT id, text FROM {tbl}").fetchall():
+        docsizes = cache.get_sizes(text, n) if cache is not None else None
+
+        if docsizes is None:
+            docsizes = set_sizes(scorer.text_sets(text, n))
+            if cache is not None:
+                cache.put_sizes(text, n, docsizes, commit=False)
+
+        sizes[id] = docsizes
+
+    if cache is not None:
+        cache.commit()
+
+    return sizes
+
+
+def bounded_scores(names):
+    """mask of the scores that are containments of ngram sets, as opposed to the modified ngram similarity"""
+
+    return np.array([not name.endswith("_mod") for name in names])
+
+
+def containment_bounds(sizesa, sizesb):
+    """upper bounds of the largest containment score of pairs, from one row of set sizes per document"""
+
+    a = np.asarray(sizesa, dtype='float64')
+    b = np.asarray(sizesb, dtype='float64')
+
+    # empty sets score 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = np.where((a > 0) & (b > 0), np.minimum(a / b, 1), 0)
+
+    # rounding to float32 is monotonic, so the stored scores stay below the rounded bound
+    return ratios.max(axis=-1).astype(SCORE_DTYPE)
+
+
+def negative_class(model):
+    classes = list(model.classes_)
+    for label in NEGATIVE_LABELS:
+        if label in classes:
+            return classes.index(label)
+    raise ValueError(f"None of the classes {classes} of the model is a negative label")
+
+
+def model_trees(model):
+    """returns the trees whose class probabilities a model averages, None if it is no tree (ensemble)"""
+
+    from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+    from sklearn.tree import DecisionTreeClassifier
+
+    # e.g. a pickled GridSearchCV
+    model = getattr(model, "best_estimator_", model)
+
+    if isinstance(model, (RandomForestClassifier, ExtraTreesClassifier)):
+        return [estimator.tree_ for estimator in model.estimators_]
+    if isinstance(model, DecisionTreeClassifier):
+        return [model.tree_]
+    return None
+
+
+def lowest_negative_probability(tree, upper, neg):
+    """the lowest probability of the negative class over all leaves of a tree
+    that an input with 0 <= x <= upper can reach"""
+
+    left = tree.children_left
+    right = tree.children_right
+    feature = tree.feature
+    threshold = tree.threshold
+    value = tree.value[:, 0, :]
+
+    lowest = 1.0
+    stack = [(0, np.zeros_like(upper), upper)]
+
+    while stack:
+        node, lo, hi = stack.pop()
+
+        if left[node] == -1:
+            lowest = min(lowest, value[node, neg] / value[node].sum())
+            continue
+
+        f, t = feature[node], threshold[node]
+
+        # the left child takes x <= t, the right child x > t
+        if lo[f] <= t:
+            lefthi = hi.copy()
+            lefthi[f] = min(hi[f], t)
+            stack.append((left[node], lo, lefthi))
+        if hi[f] > t:
+            rightlo = lo.copy()
+            rightlo[f] = max(lo[f], t)
+            stack.append((right[node], rightlo, hi))
+
+    return lowest
+
+
+def prune_threshold(model, names):
+    """returns the largest bound such that the model labels every pair whose containment scores are
+    all at most the bound as negative, whatever its modified ngram scores are. The averaged class
+    probabilities of an ensemble select the negative class for sure once they are above 0.5.
+    Returns None if the model is no tree ensemble or there is no such bound."""
+
+    trees = model_trees(model)
+    if trees is None:
+        return None
+
+    nfeatures = getattr(model, "n_features_in_", len(names))
+    if nfeatures != len(names):
+        raise ValueError(f"Model expects {nfeatures} scores, but there are {len(names)}")
+
+    neg = negative_class(model)
+    bounded = bounded_scores(names)
+
+    def negative(bound):
+        upper = np.ones(len(names))
+        upper[bounded] = bound
+        return np.mean([lowest_negative_probability(tree, upper, neg) for tree in trees]) > 0.5
+
+    # the reachable leaves only change at thresholds of the bounded scores
+    candidates = {0.0, 1.0}
+    for tree in trees:
+        for f, t in zip(tree.feature, tree.threshold):
+            if f >= 0 and bounded[f] and 0 < t < 1:
+                candidates.add(float(t))
+    candidates = sorted(candidates)
+
+    if not negative(candidates[0]):
+        return None
+
+    # the reachable leaves only grow with the bound, so search the largest negative one
+    lo, hi = 0, len(candidates) - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if negative(candidates[mid]):
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return candidates[lo]
+
+
+def models_threshold(models, names):
+    """the threshold below which all models label a pair as negative, None if one of them has none"""
+
+    thresholds = [prune_threshold(model, names) for model in models]
+    if any(t is None for t in thresholds):
+        return None
+    return min(thresholds)
+
+
+class PairPruner():
+    """Splits pairs into the ones to score and the ones whose containment bound is at most a threshold."""
+
+    def __init__(self, threshold, sources, texts):
+        self.threshold = threshold
+        self.sources = sources
+        self.texts = texts
+        self.pruned = 0
+
+    def bounds(self, pairs):
+        return containment_bounds(
+            np.stack([self.sources[ida] for ida, _ in pairs]),
+            np.stack([self.texts[idb] for _, idb in pairs])
+        )
+
+    def split(self, rows):
+        """splits (row, ida, idb) tuples into the rows to score and (ida, idb, bound) tuples of the pruned pairs"""
+
+        if not rows:
+            return [], []
+
+        bounds = self.bounds([(ida, idb) for _, ida, idb in rows])
+        keep = bounds > self.threshold
+
+        kept = [row for row, k in zip(rows, keep) if k]
+        pruned = [(ida, idb, float(b)) for (_, ida, idb), b, k in zip(rows, bounds, keep) if not k]
+
+        self.pruned += len(pruned)
+        return kept, pruned
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", dest="indb", required=True,
+        help="Path to the input SQLite DB with a ground_truth table and the scores of its pairs in a predictions table", type=Path)
+    argparser.add_argument("-m", dest="modelpaths", required=True, nargs="+",
+        help="Paths to the pickled ScikitLearn models to validate the pruning for", type=Path)
+    argparser.add_argument("-c", dest="cachedb", type=Path,
+        help="Path to a document cache DB created by preprocess.py")
+    argparser.add_argument("-l", default="en", dest="language",
+        help="Language of the documents")
+    argparser.add_argument("--mngs", default=False, action='store_true', dest="mngs",
+        help="The scores include modified ngram similarity, only used if the DB has no score_names table")
+    argparser.add_argument("--ratio", type=float, dest="ratio",
+        help="Prune pairs with a containment bound up to this value instead of deriving it from the models")
+
+    args = argparser.parse_args()
+
+    con = sqlite3.connect(args.indb)
+    cur = con.cursor()
+
+    if not has_ground_truth(con):
+        argparser.error(f"{args.indb} has no ground_truth table")
+
+    models = []
+    for modelpath in args.modelpaths:
+        with modelpath.open(mode="rb") as f:
+            models.append(pickle.load(f))
+
+    names = read_score_names(con) or metric_names(args.mngs)
+
+    threshold = args.ratio if args.ratio is not None else models_threshold(models, names)
+    if threshold is None:
+        argparser.error("No pruning bound can be derived for these models, give one with --ratio")
+    print(f"Pruning pairs with a containment bound <= {threshold}")
+
+    cache = DocumentCache(args.cachedb, args.language) if args.cachedb else None
+    scorer = NgramSimilarity(args.language, cache=cache)
+
+    st = time.time()
+    sources = document_sizes(con, scorer, "sources")
+    texts = document_sizes(con, scorer, "texts")
+    print(f"Computed the set sizes of {len(sources)} sources and {len(texts)} texts in {time.time() - st} s")
+
+    # share of the full cross join that would be skipped
+    sourcesizes = np.stack(list(sources.values())) if sources else np.zeros((0, len(names)))
+    npruned = 0
+    for textsizes in texts.values():
+        npruned += int((containment_bounds(sourcesizes, textsizes) <= threshold).sum())
+    ntotal = len(sources) * len(texts)
+    print(f"{npruned} of {ntotal} pairs are pruned ({npruned / ntotal if ntotal else 0:.4f})")
+
+    sql = """
+    SELECT predictions.ida, predictions.idb, ground_truth.label, predictions.scores
+    FROM predictions
+    INNER JOIN ground_truth
+    ON predictions.ida = ground_truth.ida AND predictions.idb = ground_truth.idb
+    """
+    rows, scores = read_scores(cur, sql)
+
+    pruner = PairPruner(threshold, sources, texts)
+    bounds = pruner.bounds([(ida, idb) for ida, idb, _ in rows]) if rows else np.zeros(0, dtype=SCORE_DTYPE)
+    pruned = bounds <= threshold
+
+    # the bounds have to hold for the scores actually computed
+    bounded = bounded_scores(names)
+    violations = int((scores[:, bounded] > bounds[:, None]).any(axis=1).sum()) if rows else 0
+
+    lost = 0
+    for modelpath, model in zip(args.modelpaths, models):
+        if not rows:
+            break
+        negative = model.classes_[negative_class(model)]
+        positive = model.predict(scores) != negative
+        modellost = int((positive & pruned).sum())
+        lost += modellost
+        print(f"{modelpath}: {modellost} of {int(positive.sum())} positive predictions pruned")
+
+    recall = dict()
+    for (_, _, label), p in zip(rows, pruned):
+        kept, total = recall.get(label, (0, 0))
+        recall[label] = (kept + int(not p), total + 1)
+    print_recall(recall)
+
+    con.close()
+
+    if violations:
+        print(f"{violations} ground truth pairs score above their bound")
+    if lost or violations:
+        sys.exit(1)
+    print("No positives lost")
+
+if __name__ == "__main__":
+    main()
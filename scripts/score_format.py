@@ -0,0 +1,86 @@
+"""
+Compact numeric storage of the text metric scores in the predictions tables. The scores of a
+pair are stored as a packed float32 BLOB in the scores column, the names of the metrics in
+score order are stored once per database in a score_names table. Rows written before as JSON
+text are still read transparently.
+"""
+
+import json
+
+import numpy as np
+
+# scikit-learn casts the input of its tree based classifiers to float32 anyway
+SCORE_DTYPE = np.dtype('float32')
+
+
+def metric_names(use_mngs=False, ngram_length=5):
+    """names of the metrics in the order NgramSimilarity and ModifiedNgramSimilarity return them"""
+
+    names = [str(n) for n in range(1, ngram_length+1)] + ["hapax"]
+    if use_mngs:
+        names += [f"{n}_mod" for n in range(1, ngram_length+1)]
+    return names
+
+
+def pack_scores(scores):
+    """packs a scores dict, a list of scores or a row of a score matrix into a BLOB"""
+
+    if isinstance(scores, dict):
+        scores = list(scores.values())
+    return np.asarray(scores, dtype=SCORE_DTYPE).tobytes()
+
+
+def unpack_scores(blob):
+    """returns the scores of one row as float32 array, for packed as well as JSON rows"""
+
+    if isinstance(blob, str):
+        return np.array(list(json.loads(blob).values()), dtype=SCORE_DTYPE)
+    return np.frombuffer(blob, dtype=SCORE_DTYPE)
+
+
+def score_matrix(blobs, nmetrics=None):
+    """decodes the scores column of many rows into one (rows, metrics) float32 matrix"""
+
+    blobs = list(blobs)
+
+    if not blobs:
+        return np.zeros((0, nmetrics or 0), dtype=SCORE_DTYPE)
+
+    if all(isinstance(b, bytes) for b in blobs):
+        matrix = np.frombuffer(b"".join(blobs), dtype=SCORE_DTYPE)
+        return matrix.reshape(len(blobs), -1)
+
+    return np.stack([unpack_scores(b) for b in blobs])
+
+
+def setup_score_names(con, names):
+    """records the metric names of a predictions DB, raises if it already holds other metrics"""
+
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS score_names (
+        position INTEGER PRIMARY KEY,
+        name TEXT NOT NULL
+    )""")
+
+    stored = read_score_names(con)
+    if not stored:
+        con.executemany("INSERT INTO score_names VALUES (?, ?)", enumerate(names))
+        con.commit()
+    elif stored != list(names):
+        raise ValueError(f"Predictions DB holds the scores {stored}, not {list(names)}")
+
+
+def read_score_names(con):
+    """returns the metric names of a predictions DB, empty for DBs without a score_names table"""
+
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='score_names'").fetchone() is None:
+        return []
+    return [name for name, in con.execute("SELECT name FROM score_names ORDER BY position")]
+
+
+def read_scores(cur, sql, params=()):
+    """runs a query whose last column is a scores column and returns
+    the other columns as list of tuples and the scores as matrix"""
+
+    rows = cur.execute(sql, params).fetchall()
+    return [row[:-1] for row in rows], score_matrix(row[-1] for row in rows)
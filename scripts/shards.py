@@ -0,0 +1,247 @@
+"""
+This script splits the pair space of an inference run into deterministic shards, runs own_infer.py
+once per shard (locally, as several processes standing in for nodes) and merges the resulting
+shard databases into one predictions database.
+
+Usage:
+    python shards.py plan -i own.db -n 4
+    python shards.py run -i own.db -m ../classifier/modell5.pickle -n 4 -o predictions.db -- --mngs -c cache.db
+    python shards.py merge -o predictions.db shard_*.db
+"""
+
+import sqlite3
+import argparse
+import subprocess
+import multiprocessing
+import sys
+import time
+import zlib
+
+from pathlib import Path
+
+from score_format import setup_score_names, read_score_names
+from db_writer import BulkWriter
+
+
+def shard_of(ida, idb, nshards):
+    """assigns a pair to one of nshards shards, stable across runs and machines"""
+
+    return zlib.crc32(f"{ida}\x1f{idb}".encode("utf-8")) % nshards
+
+
+def register_shard_function(con):
+    con.create_function("shard_of", 3, shard_of, deterministic=True)
+
+
+def plan_shards(con, nshards):
+    """counts the pairs of the sources x texts cross join per shard"""
+
+    register_shard_function(con)
+
+    sql = """
+    SELECT
+        shard_of(sources.id, texts.id, ?) AS shard,
+        COUNT(*)
+    FROM
+        sources
+    CROSS JOIN
+        texts
+    GROUP BY
+        shard
+    ORDER BY
+        shard
+    """
+
+    return dict(con.execute(sql, (nshards,)).fetchall())
+
+
+def shard_path(outdb, shard, nshards):
+    outdb = Path(outdb)
+    return outdb.with_name(f"{outdb.stem}_shard{shard}of{nshards}{outdb.suffix}")
+
+
+def merge_databases(outdb, paths):
+    """merges the predictions of several output DBs into one with bulk INSERT ... SELECT.
+    Documents are only marked as scored if every merged DB marks them. All DBs have to hold the same scores."""
+
+    st = time.time()
+
+    con = sqlite3.connect(outdb)
+    con.executescript("""
+    CREATE TABLE IF NOT EXISTS predictions (
+        ida INTEGER NOT NULL,
+        idb INTEGER NOT NULL,
+        scores BLOB,
+        label TEXT,
+        FOREIGN KEY(ida) REFERENCES sources(id)
+        FOREIGN KEY(idb) REFERENCES texts(id)
+        PRIMARY KEY (ida, idb)
+    );
+
+    CREATE TABLE IF NOT EXISTS scored_documents (
+        tbl TEXT NOT NULL,
+        id NOT NULL,
+        model TEXT NOT NULL,
+        run_id INTEGER,
+        PRIMARY KEY (tbl, id, model)
+    );
+
+    CREATE TABLE IF NOT EXISTS models (
+        model TEXT PRIMARY KEY,
+        path TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS model_labels (
+        ida INTEGER NOT NULL,
+        idb INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        label TEXT,
+        PRIMARY KEY (ida, idb, model)
+    );
+
+    CREATE TABLE IF NOT EXISTS pruned_pairs (
+        ida INTEGER NOT NULL,
+        idb INTEGER NOT NULL,
+        bound REAL,
+        run_id INTEGER,
+        PRIMARY KEY (ida, idb)
+    );
+    """)
+
+    shards = []
+
+    # the shards are inspected up front, so the output DB is only written by the writer thread
+    for p in paths:
+        shardcon = sqlite3.connect(p)
+        tables = {name for name, in shardcon.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+        if "score_names" in tables:
+            setup_score_names(con, read_score_names(shardcon))
+
+        shards.append((p, tables))
+        shardcon.close()
+
+    con.close()
+
+    scored = None
+
+    with BulkWriter(outdb) as writer:
+        writer.defer("CREATE INDEX IF NOT EXISTS predictions_label ON predictions (label)")
+
+        for p, tables in shards:
+            inserts = []
+
+            if "predictions" in tables:
+                inserts.append("""
+                INSERT OR IGNORE INTO predictions (ida, idb, scores, label)
+                SELECT ida, idb, scores, label FROM shard.predictions;""")
+
+            for table in ["models", "model_labels"]:
+                if table in tables:
+                    inserts.append(f"INSERT OR IGNORE INTO {table} SELECT * FROM shard.{table};")
+
+            # run ids are only meaningful within the DB of one shard
+            if "pruned_pairs" in tables:
+                inserts.append("""
+                INSERT OR IGNORE INTO pruned_pairs (ida, idb, bound)
+                SELECT ida, idb, bound FROM shard.pruned_pairs;""")
+
+            # one transaction per shard, ATTACH and DETACH have to happen outside of it
+            path = str(p).replace("'", "''")
+            writer.executescript(f"""
+            ATTACH DATABASE '{path}' AS shard;
+            BEGIN;
+            {"".join(inserts)}
+            COMMIT;
+            DETACH DATABASE shard;""")
+
+            # read while the writer thread copies the shard
+            shardcon = sqlite3.connect(p)
+            if "scored_documents" in tables:
+                rows = set(shardcon.execute("SELECT tbl, id, model FROM scored_documents"))
+            else:
+                rows = set()
+            scored = rows if scored is None else scored & rows
+            shardcon.close()
+
+            print(f"Queued {p}")
+
+        if scored:
+            writer.executemany("INSERT OR IGNORE INTO scored_documents VALUES (?, ?, ?, NULL)", scored)
+
+    print(f"Merged {len(shards)} DBs in {time.time() - st} s")
+
+
+def run_local(args, extra):
+    """runs one own_infer.py process per shard on this machine and merges their outputs"""
+
+    infer = Path(__file__).with_name("own_infer.py")
+    threads = args.njobs // args.nshards or 1
+
+    procs = []
+    for shard in range(args.nshards):
+        cmd = [
+            sys.executable, str(infer),
+            "-i", str(args.indb),
+            "-m", *map(str, args.modelpaths),
+            "-o", str(shard_path(args.outdb, shard, args.nshards)),
+            "-t", str(threads),
+            "--shards", str(args.nshards),
+            "--shard", str(shard),
+            *extra
+        ]
+        print(f"Starting shard {shard}: {' '.join(cmd)}")
+        procs.append(subprocess.Popen(cmd))
+
+    failed = [shard for shard, proc in enumerate(procs) if proc.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed, not merging. Rerun them with --resume")
+
+    merge_databases(args.outdb, [shard_path(args.outdb, shard, args.nshards) for shard in range(args.nshards)])
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    subparsers = argparser.add_subparsers(dest="command", required=True)
+
+    planparser = subparsers.add_parser("plan", help="Print the number of pairs per shard")
+    planparser.add_argument("-i", dest="indb", required=True,
+        help="Path to the input SQLite DB", type=Path)
+    planparser.add_argument("-n", dest="nshards", required=True, type=int,
+        help="Number of shards")
+
+    runparser = subparsers.add_parser("run", help="Run all shards as local processes and merge them")
+    runparser.add_argument("-i", dest="indb", required=True,
+        help="Path to the input SQLite DB", type=Path)
+    runparser.add_argument("-m", dest="modelpaths", required=True, nargs="+",
+        help="Paths to the pickled ScikitLearn models to use", type=Path)
+    runparser.add_argument("-o", default=Path("predictions.db"), dest="outdb",
+        help="Path to the merged output SQLite DB, shard DBs are placed next to it", type=Path)
+    runparser.add_argument("-n", dest="nshards", required=True, type=int,
+        help="Number of shards")
+    runparser.add_argument("-t", default=multiprocessing.cpu_count(), type=int, dest="njobs",
+        help="Total number of processes, split evenly between the shards")
+    runparser.add_argument("extra", nargs=argparse.REMAINDER,
+        help="Additional arguments passed on to own_infer.py after --")
+
+    mergeparser = subparsers.add_parser("merge", help="Merge shard DBs into one predictions DB")
+    mergeparser.add_argument("-o", default=Path("predictions.db"), dest="outdb",
+        help="Path to the merged output SQLite DB", type=Path)
+    mergeparser.add_argument("paths", nargs="+", type=Path,
+        help="Shard DBs to merge")
+
+    args = argparser.parse_args()
+
+    if args.command == "plan":
+        con = sqlite3.connect(args.indb)
+        for shard, count in plan_shards(con, args.nshards).items():
+            print(f"Shard {shard}: {count} pairs")
+        con.close()
+    elif args.command == "run":
+        extra = args.extra[1:] if args.extra[:1] == ["--"] else args.extra
+        run_local(args, extra)
+    elif args.command == "merge":
+        merge_databases(args.outdb, args.paths)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+This script precompiles the synonyms used by the modified ngram similarity into a memory-mapped
+lemma -> synonym hash table, keyed by (lemma hash, POS). The table is built once from GermaNet
+or WordNet and can then be shared read-only by all worker processes instead of every worker
+loading the full wordnet and querying it.
+
+Usage:
+    python synonym_table.py -l de -o synonyms_de
+"""
+
+import argparse
+import json
+import time
+
+from pathlib import Path
+
+import numpy as np
+
+from spacy.strings import hash_string as spacy_hash_string
+from spacy.parts_of_speech import IDS as POS_IDS
+
+from ngram_similarity import extend_hashes, FNV_OFFSET
+
+GERMANET_PATH = "../ressourcen/GermaNet/GN_V140/GN_V140_XML/"
+
+SYNONYM_POS = ["NOUN", "VERB", "ADJ", "ADV"]
+
+
+def load_wordnet(language):
+    if language == "en":
+        from nltk.corpus import wordnet as wn
+        return wn
+    elif language == "de":
+        from germanetpy import germanet
+        return germanet.Germanet(GERMANET_PATH)
+    else:
+        raise ValueError(f"Unsupported language {language}")
+
+
+def lemma_synonyms(wn, language, lemma, pos):
+    """returns up to 10 synonyms for a lemma with a spaCy POS tag from WordNet or GermaNet"""
+
+    if language == "en":
+        posmap = {
+            "NOUN": "n",
+            "VERB": "v",
+            "ADJ": "a",
+            "ADV": "r",
+        }
+
+        wnpos = posmap[pos]
+        ss = wn.synsets(lemma, wnpos)
+        if len(ss) == 1:
+            lemmaset = {l.name() for l in ss[0].lemmas() if not "_" in l.name() and l.name() != lemma}
+        else:
+            lemmaset = {s.lemmas()[0].name() for s in ss if not "_" in s.lemmas()[0].name() and s.lemmas()[0].name() != lemma}
+
+        return list(lemmaset)[:10]
+    elif language == "de":
+        posmap = {
+            "NOUN": "nomen",
+            "VERB": "verben",
+            "ADJ": "adj",
+            "ADV": None,
+        }
+
+        wnpos = posmap[pos]
+
+        if not wnpos:
+            return [lemma]
+        else:
+            ss = wn.get_synsets_by_orthform(lemma)
+
+            if len(ss) == 1 and ss[0].word_category.name == wnpos:
+                output = {lu.orthform for lu in ss[0].lexunits if lu.orthform != lemma}
+            else:
+                output = set()
+                for s in ss:
+                    if s.word_category.name == wnpos:
+                        for lu in s.lexunits:
+                            if lu.orthform != lemma:
+                                output.add(lu.orthform)
+
+            return list(output)[:10]
+
+
+def wordnet_lemmas(wn, language):
+    """yields every form a lookup in the wordnet can succeed for"""
+
+    if language == "en":
+        for wnpos in ["n", "v", "a", "r"]:
+            yield from wn.all_lemma_names(wnpos)
+    elif language == "de":
+        for lu in wn.lexunits.values():
+            for attr in ["orthform", "orthvar", "old_orthform", "old_orthvar"]:
+                form = getattr(lu, attr, None)
+                if form:
+                    yield form
+
+
+def table_keys(lemmas, pos):
+    """combines lemma hashes and spaCy POS ids into table keys"""
+
+    lemmas = np.asarray(lemmas, dtype='uint64')
+    keys = extend_hashes(np.full(len(lemmas), FNV_OFFSET, dtype='uint64'), lemmas)
+    return extend_hashes(keys, np.asarray(pos, dtype='uint64'))
+
+
+class SynonymTable():
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+        with (self.path / "meta.json").open(encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.language = self.meta["language"]
+
+        # memory-mapped, so the pages are shared between all processes using the table
+        self.keys = np.load(self.path / "keys.npy", mmap_mode='r')
+        self.offsets = np.load(self.path / "offsets.npy", mmap_mode='r')
+        self.values = np.load(self.path / "values.npy", mmap_mode='r')
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def find(self, keys):
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype='int64'), np.zeros(len(keys), dtype=bool)
+
+        idx = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return idx, self.keys[idx] == keys
+
+    def lookup(self, lemma, pos):
+        """returns the synonym hashes of a single lemma hash and spaCy POS id or None"""
+
+        (idx,), (found,) = self.find(table_keys([lemma], [pos]))
+        if not found:
+            return None
+        return [int(v) for v in self.values[self.offsets[idx]:self.offsets[idx+1]]]
+
+    def options(self, lemmas, pos):
+        """returns the lemma options of a whole document as flat array with offsets:
+        the synonym hashes for tokens that have synonyms, the lemma hash itself for all others"""
+
+        lemmas = np.asarray(lemmas, dtype='uint64')
+
+        if len(self.keys) == 0:
+            return lemmas.copy(), np.arange(len(lemmas) + 1, dtype='int64')
+
+        idx, found = self.find(table_keys(lemmas, pos))
+
+        lengths = np.where(found, self.offsets[idx+1] - self.offsets[idx], 1)
+        offsets = np.zeros(len(lemmas) + 1, dtype='int64')
+        np.cumsum(lengths, out=offsets[1:])
+
+        within = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+        flat_found = np.repeat(found, lengths)
+        positions = np.repeat(np.where(found, self.offsets[idx], 0), lengths) + within
+
+        options = np.repeat(lemmas, lengths)
+        options[flat_found] = self.values[positions[flat_found]]
+
+        return options, offsets
+
+
+def build_synonym_table(language, path):
+    """precomputes lemma_synonyms for every lemma of the wordnet and POS and saves the table to path"""
+
+    wn = load_wordnet(language)
+
+    entries = dict()
+
+    for lemma in set(wordnet_lemmas(wn, language)):
+        for pos in SYNONYM_POS:
+            synonyms = lemma_synonyms(wn, language, lemma, pos)
+
+            # tokens without a table entry fall back to their own lemma
+            if not synonyms or synonyms == [lemma]:
+                continue
+
+            key = int(table_keys([spacy_hash_string(lemma)], [POS_IDS[pos]])[0])
+            entries[key] = [spacy_hash_string(l) for l in synonyms]
+
+    keys = np.array(sorted(entries), dtype='uint64')
+    lengths = np.array([len(entries[int(k)]) for k in keys], dtype='int64')
+    offsets = np.zeros(len(keys) + 1, dtype='int64')
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.array([v for k in keys for v in entries[int(k)]], dtype='uint64')
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    np.save(path / "keys.npy", keys)
+    np.save(path / "offsets.npy", offsets)
+    np.save(path / "values.npy", values)
+
+    with (path / "meta.json").open(mode="w", encoding="utf-8") as f:
+        json.dump({"language": language, "entries": len(keys), "synonyms": len(values)}, f)
+
+    return len(keys)
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-l", default="de", dest="language",
+        help="Language of the wordnet to compile, de for GermaNet or en for WordNet")
+    argparser.add_argument("-o", dest="outpath", required=True, type=Path,
+        help="Directory to write the synonym table to")
+
+    args = argparser.parse_args()
+
+    st = time.time()
+    nentries = build_synonym_table(args.language, args.outpath)
+    print(f"Compiled {nentries} (lemma, POS) entries in {time.time() - st} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import sqlite3
+import os
+
+from pathlib import Path
+
+from lru_cache import LRUCache
+
+TABLES = ["sources", "texts"]
+
+
+class TextStore():
+    """Read-only access to the document texts of an input DB by id.
+
+    Every process opens its own read-only connection, so worker processes only need to be sent
+    document ids instead of the texts themselves. Recently used texts are kept in an LRU."""
+
+    def __init__(self, path, memory_bytes=64 * 2**20):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.memory = LRUCache(memory_bytes)
+
+        self._con = None
+        self._pid = None
+
+    @property
+    def con(self):
+        if self._pid != os.getpid():
+            self._con = sqlite3.connect(f"{Path(self.path).resolve().as_uri()}?mode=ro", uri=True)
+            self._pid = os.getpid()
+        return self._con
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_con"] = None
+        state["_pid"] = None
+        state["memory"] = LRUCache(self.memory_bytes)
+        return state
+
+    def text(self, tbl, id):
+        return self.texts(tbl, [id])[0]
+
+    def texts(self, tbl, ids):
+        """returns the texts of documents of a table in the order of ids, fetching missing ones in one query"""
+
+        if tbl not in TABLES:
+            raise ValueError(f"Unknown document table {tbl}")
+
+        found = dict()
+        for id in set(ids):
+            text = self.memory.get((tbl, id))
+            if text is not None:
+                found[id] = text
+
+        missing = [id for id in set(ids) if id not in found]
+
+        # stay below SQLite's default limit of host parameters
+        for i in range(0, len(missing), 900):
+            part = missing[i:i+900]
+            sql = f"SELECT id, text FROM {tbl} WHERE id IN ({', '.join('?' * len(part))})"
+            for id, text in self.con.execute(sql, part):
+                found[id] = self.memory.put((tbl, id), text)
+
+        for id in ids:
+            if id not in found:
+                raise KeyError(f"No document {id} in {tbl} of {self.path}")
+        return [found[id] for id in ids]
+
+    def close(self):
+        if self._con is not None and self._pid == os.getpid():
+            self._con.close()
+        self._con = None
+        self._pid = None
@@ -0,0 +1,71 @@
+"""
+Tokenization stage shared by both similarity metrics. Loads a spaCy pipeline with only the
+components lemmas and POS tags depend on and turns parsed documents into compact arrays.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import spacy
+
+from spacy.attrs import LEMMA, POS, IDX, LENGTH
+
+MODELS = {
+    "de": "de_core_news_sm",
+    "en": "en_core_web_sm",
+}
+
+# everything else (parser, ner, senter, ...) is removed from the pipeline
+REQUIRED_PIPES = ["tok2vec", "tagger", "morphologizer", "attribute_ruler", "lemmatizer", "trainable_lemmatizer"]
+
+# structure of arrays over all tokens of a document: uint64 lemma hashes, uint8 spaCy POS ids
+# (the universal POS ids all fit into a byte) and uint32 character offsets as (start, end) rows
+TokenArrays = namedtuple("TokenArrays", ["lemmas", "pos", "offsets"])
+
+
+def load_pipeline(language):
+    if language not in MODELS:
+        raise ValueError(f"Unsupported language {language}")
+
+    nlp = spacy.load(MODELS[language], disable=["parser", "ner"])
+
+    for name in list(nlp.component_names):
+        if name not in REQUIRED_PIPES:
+            nlp.remove_pipe(name)
+
+    nlp.max_length = 2_000_000
+
+    return nlp
+
+
+def doc_arrays(doc):
+    """extracts the TokenArrays of a parsed document"""
+
+    arr = doc.to_array([LEMMA, POS, IDX, LENGTH]).reshape(-1, 4)
+
+    offsets = np.empty((len(arr), 2), dtype='uint32')
+    offsets[:, 0] = arr[:, 2]
+    offsets[:, 1] = arr[:, 2] + arr[:, 3]
+
+    return TokenArrays(
+        np.ascontiguousarray(arr[:, 0], dtype='uint64'),
+        np.ascontiguousarray(arr[:, 1], dtype='uint8'),
+        offsets
+    )
+
+
+def ngram_view(values, n):
+    """returns all ngrams of length n of a token array as a read-only strided (count, n) view,
+    without copying the array or building tuples"""
+
+    values = np.asarray(values)
+    if len(values) < n:
+        return np.empty((0, n), dtype=values.dtype)
+    return np.lib.stride_tricks.sliding_window_view(values, n)
+
+
+def pipe_arrays(nlp, items, batch_size=64, n_process=1):
+    """streams (text, context) tuples through nlp.pipe and yields (TokenArrays, doc, context)"""
+
+    for doc, context in nlp.pipe(items, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        yield doc_arrays(doc), doc, context